@@ -10,7 +10,25 @@ import time
 import sys
 import zipfile
 import shutil
+import tempfile
+import errno
+import sqlite3
+import socket
+import argparse
+import contextlib
+import io
+import select
+import struct
+import ctypes
+import ctypes.util
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import timedelta
+from collections import deque
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import mutagen
 from mutagen.easyid3 import EasyID3
 from mutagen.mp4 import MP4, MP4Tags
 from tkinter import ttk
@@ -43,7 +61,20 @@ def load_config():
         "duration_max": 600,
         "transcode_mp3": "false",
         "generate_m3u": "true",
-        "exclude_instrumentals": "false"
+        "exclude_instrumentals": "false",
+        "library_roots": [],
+        "library_link_mode": "hardlink",
+        "format_policy": "best",
+        "format_min_abr": 96,
+        "format_codecs": ["mp4a", "opus"],
+        "output_shard": "none",
+        "timeout_call": 60,
+        "timeout_download": 900,
+        "budget_track": 90,
+        "budget_run": 0,
+        "bulk_window": 50,
+        "scratch_dir": "",
+        "scratch_max_mb": 1024
     }
     if os.path.isfile(CONFIG_FILE):
         try:
@@ -55,6 +86,2004 @@ def load_config():
     return default
 
 
+AUDIO_EXTENSIONS = ('.mp3', '.m4a')
+# Per-user, so it survives between runs of the onefile build (whose _MEIPASS is deleted on exit)
+LIBRARY_INDEX_FILE = os.path.join(os.path.expanduser('~'), '.spotify2mp3', 'library_index.json')
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return ' '.join(re.sub(r"[^\w\s]", "", (text or '').lower()).split())
+
+
+def split_primary_artist(artist_raw):
+    return re.split(r'[,/&]| feat\.| ft\.', artist_raw or '', flags=re.I)[0].strip()
+
+
+def tag_audio_file(path, title, artist, album, track_number=None):
+    """Write title/artist/album (and track number for MP3) into an M4A or MP3 file."""
+    if path.lower().endswith('.m4a'):
+        audio = MP4(path); tags = audio.tags or MP4Tags()
+        tags['\xa9nam']=[title]; tags['\xa9ART']=[artist]; tags['\xa9alb']=[album]; audio.save()
+    else:
+        audio = EasyID3()
+        try: audio.load(path)
+        except: pass
+        audio.update({'artist':artist,'title':title,'album':album})
+        if track_number is not None:
+            audio['tracknumber'] = str(track_number)
+        audio.save(path)
+
+
+def link_or_copy(src, dest, mode='hardlink'):
+    """Hardlink src to dest, falling back to a copy across devices. Returns the mode used.
+
+    The link or copy is made under a temporary name and renamed over dest, so
+    an existing dest is only replaced once the new file is in place.
+    """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return 'hardlink'
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.linking")
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    used = 'copy'
+    try:
+        if mode == 'hardlink':
+            try:
+                os.link(src, tmp)
+                used = 'hardlink'
+            except OSError:
+                pass
+        if used == 'copy':
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return used
+
+
+class LibraryIndex:
+    """Persistent title/artist/duration index of an existing music library.
+
+    Entries are keyed by path and carry the file's mtime and size, so a rescan
+    only re-reads tags for files that were added or changed since the last run.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path=LIBRARY_INDEX_FILE):
+        self.path = path
+        self.files = {}
+        self._by_key = None
+
+    def load(self):
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.files = data.get('files', {})
+            except Exception as e:
+                print(f"Warning: could not read library index {self.path}: {e}")
+                self.files = {}
+        self._by_key = None
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'files': self.files}, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _walk(root):
+        found = []
+        for dirpath, _dirs, names in os.walk(root):
+            for name in names:
+                if name.lower().endswith(AUDIO_EXTENSIONS) and not name.startswith('.'):
+                    found.append(os.path.join(dirpath, name))
+        return found
+
+    @staticmethod
+    def _read_entry(path, st):
+        try:
+            audio = mutagen.File(path, easy=True)
+        except Exception as e:
+            print(f"Warning: could not read tags from {path}: {e}")
+            audio = None
+        tags = (audio.tags if audio is not None else None) or {}
+        title = (tags.get('title') or [''])[0]
+        artist = (tags.get('artist') or [''])[0]
+        duration = getattr(getattr(audio, 'info', None), 'length', 0) or 0
+        return {
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'title': normalize_text(title),
+            'artist': normalize_text(split_primary_artist(artist)),
+            'duration': round(duration, 1),
+        }
+
+    def scan(self, roots, workers=8):
+        """Incrementally rescan library roots. Returns (added_or_updated, removed)."""
+        roots = [os.path.abspath(r) for r in roots if r and os.path.isdir(r)]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(roots) or 1))) as pool:
+            paths = [p for found in pool.map(self._walk, roots) for p in found]
+
+        seen = set(paths)
+        removed = [p for p in self.files if p not in seen]
+        for p in removed:
+            del self.files[p]
+
+        changed = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            old = self.files.get(p)
+            if not old or old.get('mtime') != st.st_mtime or old.get('size') != st.st_size:
+                changed.append((p, st))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (p, _st), entry in zip(changed, pool.map(lambda a: self._read_entry(*a), changed)):
+                self.files[p] = entry
+
+        self._by_key = None
+        return len(changed), len(removed)
+
+    def lookup(self, title, artist, duration=None, extensions=AUDIO_EXTENSIONS, tolerance=10, exclude=None):
+        """Return the path of the best library file for a track, or None.
+
+        Files under the exclude folder (the run's own output) are never offered.
+        """
+        skip = os.path.join(os.path.abspath(exclude), '') if exclude else None
+        if self._by_key is None:
+            self._by_key = {}
+            for p, e in self.files.items():
+                if e.get('title'):
+                    self._by_key.setdefault((e['title'], e.get('artist', '')), []).append(p)
+
+        candidates = self._by_key.get((normalize_text(title), normalize_text(split_primary_artist(artist))), [])
+        best = None
+        for p in candidates:
+            if not p.lower().endswith(extensions) or not os.path.isfile(p):
+                continue
+            if skip and os.path.abspath(p).startswith(skip):
+                continue
+            delta = abs(self.files[p].get('duration', 0) - duration) if duration else 0
+            if delta > tolerance:
+                continue
+            if best is None or delta < best[0]:
+                best = (delta, p)
+        return best[1] if best else None
+
+
+def contains_keywords_in_order(candidate_title: str, keywords: list[str]) -> bool:
+    txt = normalize_text(candidate_title)
+    pos = 0
+    for kw in keywords:
+        idx = txt.find(kw, pos)
+        if idx < 0:
+            return False
+        pos = idx + len(kw)
+    return True
+
+
+def find_tools(config=None):
+    """Locate ffmpeg and yt-dlp. config may override either with ffmpeg_path / yt_dlp_path."""
+    config = config or {}
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    if platform.system() == "Darwin":
+        ffmpeg_exe = os.path.join(resource_path("ffmpeg"), "ffmpeg")
+        yt_dlp_exe = os.path.join(resource_path("yt-dlp"), "yt-dlp")
+    elif platform.system() == "Linux":
+        ffmpeg_exe = shutil.which("ffmpeg") or "ffmpeg"
+        yt_dlp_exe = shutil.which("yt-dlp") or "yt-dlp"
+    else:
+        ffmpeg_exe = os.path.join(base_dir, "ffmpeg", "ffmpeg.exe")
+        yt_dlp_exe = os.path.join(base_dir, "yt-dlp", "yt-dlp.exe")
+    return config.get('ffmpeg_path') or ffmpeg_exe, config.get('yt_dlp_path') or yt_dlp_exe
+
+
+def missing_tools(ffmpeg_exe, yt_dlp_exe):
+    missing = []
+    if not os.path.isfile(ffmpeg_exe): missing.append('ffmpeg')
+    if not os.path.isfile(yt_dlp_exe): missing.append('yt-dlp')
+    return missing
+
+
+def open_library(config, status=print):
+    """Load and incrementally rescan the library index, or None when no library roots are configured."""
+    library_roots = config.get('library_roots') or []
+    if not library_roots:
+        return None
+    status('Indexing music library...')
+    library = LibraryIndex(config.get('library_index_path') or LIBRARY_INDEX_FILE).load()
+    changed, removed = library.scan(library_roots)
+    library.save()
+    print(f"Library index: {len(library.files)} files ({changed} re-read, {removed} removed)")
+    return library
+
+
+def read_csv_rows(csv_path):
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def row_fields(row, playlist_name):
+    """Pull (title, primary artist, album, duration in seconds) out of an Exportify/TuneMyMusic row."""
+    title = row.get('Track Name') or row.get('Track name') or 'Unknown'
+    artist_raw = row.get('Artist Name(s)') or row.get('Artist name') or 'Unknown'
+    album = row.get('Album Name') or row.get('Album') or playlist_name
+    spotify_ms = row.get('Duration (ms)')
+    spotify_sec = int(spotify_ms) / 1000 if spotify_ms and spotify_ms.isdigit() else None
+    return title, split_primary_artist(artist_raw), album, spotify_sec
+
+
+NOT_FOUND_FIELDS = ['Track Name','Artist Name(s)','Album Name','Track Number','Error']
+
+
+def write_not_found_csv(output_dir, playlist_name, not_found_songs):
+    nf_path = os.path.join(output_dir, f"{playlist_name}_not_found.csv")
+    with open(nf_path, 'w', newline='', encoding='utf-8') as cf:
+        writer = csv.DictWriter(cf, fieldnames=NOT_FOUND_FIELDS)
+        writer.writeheader()
+        writer.writerows(not_found_songs)
+    return nf_path
+
+
+def write_m3u(output_dir, playlist_name, audio_files):
+    """Write the playlist. audio_files are paths relative to output_dir (possibly in shard subfolders), in track order."""
+    m3u_filename = playlist_name.replace('_',' ')
+    m3u_path = os.path.join(output_dir, f"{m3u_filename}.m3u")
+    with open(m3u_path,'w',encoding='utf-8') as m3u:
+        m3u.write('#EXTM3U\n')
+        for fn in audio_files:
+            m3u.write(f'#EXTINF:-1,{os.path.splitext(os.path.basename(fn))[0]}\n')
+            m3u.write(f'{fn}\n')
+    return m3u_path
+
+
+class OutputLayout:
+    """Where each track's file goes inside the playlist folder.
+
+    Track numbers are zero-padded to the width of the track count (at least
+    3), so names keep sorting correctly past 999 tracks. shard optionally
+    spreads files over subfolders: 'hundreds' (001-100, 101-200, ...) or
+    'album'. All paths are relative to the playlist folder.
+    """
+
+    SHARDS = ('none', 'hundreds', 'album')
+
+    def __init__(self, shard='none'):
+        self.shard = shard if shard in self.SHARDS else 'none'
+
+    @staticmethod
+    def width(total):
+        return max(3, len(str(total or 0)))
+
+    def subdir(self, i, total, album=''):
+        if self.shard == 'hundreds':
+            w = self.width(total)
+            first = (i - 1) // 100 * 100 + 1
+            return f"{first:0{w}d}-{first + 99:0{w}d}"
+        if self.shard == 'album':
+            return re.sub(r"[^\w\s-]", "", album or '').strip() or 'Unknown Album'
+        return ''
+
+    def base(self, i, total, title, variant='', album=''):
+        """Relative path without extension for track i of total."""
+        file_title = re.sub(r"[^\w\s]", "", title).strip()
+        name = f"{i:0{self.width(total)}d} - {file_title}" + (f" - {variant}" if variant else "")
+        sub = self.subdir(i, total, album)
+        return os.path.join(sub, name) if sub else name
+
+
+DEFAULT_AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio'
+
+
+def audio_only_formats(formats):
+    return [f for f in formats or [] if isinstance(f, dict) and f.get('format_id')
+            and f.get('vcodec') in (None, 'none') and f.get('acodec') not in (None, 'none')]
+
+
+def format_bytes(fmt, duration=None):
+    """Known or estimated size of a format in bytes (None if neither size nor bitrate is known)."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    abr = fmt.get('abr') or fmt.get('tbr')
+    if abr and duration:
+        return int(abr * 125 * duration)
+    return None
+
+
+def default_audio_format(formats):
+    """The format yt-dlp picks for DEFAULT_AUDIO_FORMAT: best M4A audio, else best audio."""
+    audio = audio_only_formats(formats)
+    m4a = [f for f in audio if f.get('ext') == 'm4a']
+    pool = m4a or audio
+    return max(pool, key=lambda f: f.get('abr') or 0) if pool else None
+
+
+def pick_audio_format(formats, duration, transcode_mp3, min_abr=0, codecs=('mp4a', 'opus')):
+    """Smallest audio-only format that meets the bitrate floor and suits the output mode.
+
+    M4A mode remuxes without re-encoding, so only AAC (mp4a) streams
+    qualify there; MP3 mode re-encodes anyway and accepts any listed codec.
+    """
+    allowed = ('mp4a',) if not transcode_mp3 else tuple(codecs) + ('mp3',)
+    ok = [f for f in audio_only_formats(formats)
+          if (f.get('acodec') or '').startswith(allowed) and (f.get('abr') or 0) >= min_abr
+          and format_bytes(f, duration)]
+    return min(ok, key=lambda f: format_bytes(f, duration)) if ok else None
+
+
+def audio_format_selector(transcode_mp3, min_abr=0, codecs=('mp4a', 'opus')):
+    """yt-dlp -f expression for the smallest-stream policy, used when no format list was probed."""
+    allowed = ['mp4a'] if not transcode_mp3 else list(codecs)
+    return f"worstaudio[abr>={min_abr}][acodec~='^({'|'.join(allowed)})']/{DEFAULT_AUDIO_FORMAT}"
+
+
+class RunBudget:
+    """Wall-clock budget shared by every row of one run.
+
+    Once the rows left would not fit in the time left at the average pace so
+    far (or the time is simply up), under_pressure() turns true for the rest
+    of the run and the engine drops to fast mode.
+    """
+
+    def __init__(self, seconds, total):
+        self.seconds = seconds
+        self.total = total
+        self.started = time.monotonic()
+        self.done = 0
+        self.tripped = False
+        self.lock = threading.Lock()
+
+    def row_done(self):
+        with self.lock:
+            self.done += 1
+
+    def time_left(self):
+        """Seconds left in the run, or None when it has no budget."""
+        if not self.seconds:
+            return None
+        return self.seconds - (time.monotonic() - self.started)
+
+    def under_pressure(self):
+        if not self.seconds:
+            return False
+        with self.lock:
+            if not self.tripped:
+                elapsed = time.monotonic() - self.started
+                remaining = self.seconds - elapsed
+                rows_left = self.total - self.done
+                # Wait for a few rows before trusting the average
+                if remaining <= 0 or (self.done >= 3 and elapsed / self.done * rows_left > remaining):
+                    self.tripped = True
+                    print(f"Run budget: {rows_left} rows left with {max(remaining, 0):.0f}s to go, switching to fast mode")
+            return self.tripped
+
+
+class QueryCache:
+    """yt-dlp search and probe results memoized for one run.
+
+    Rows that repeat a query (re-listed tracks, the same song on two albums)
+    reuse the earlier answer instead of launching yt-dlp again. Timeouts and
+    other empty answers are not kept, so they are retried.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.saved = 0
+        # Bulk-resolved answers: their first use is not a saved search
+        self.prefetched = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            hit = self.results.get(key)
+            if hit is not None:
+                if key in self.prefetched:
+                    self.prefetched.discard(key)
+                else:
+                    self.saved += 1
+            return hit
+
+    def put(self, key, value, prefetched=False):
+        with self.lock:
+            self.results[key] = value
+            if prefetched:
+                self.prefetched.add(key)
+
+    def peek(self, key):
+        with self.lock:
+            return self.results.get(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.results
+
+
+BUDGET_REPORT_FIELDS = ['Track Number','Track Name','Artist Name(s)','Fallback']
+
+
+def write_budget_report(output_dir, playlist_name, records):
+    """List the rows whose match was cut short by a time budget."""
+    path = os.path.join(output_dir, f"{playlist_name}_budget_report.csv")
+    with open(path, 'w', newline='', encoding='utf-8') as cf:
+        writer = csv.DictWriter(cf, fieldnames=BUDGET_REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    return path
+
+
+# Scratch reserved per track when the download size is not known up front
+SCRATCH_TRACK_BYTES = 20 * 1048576
+
+
+class ScratchArea:
+    """Local working space for downloads and post-processing, bounded to max_bytes.
+
+    Each track in flight reserves space and gets its own directory. reserve()
+    blocks while the tracks already in flight would push usage past the bound
+    (one track is always let through), so downloads wait for earlier tracks to
+    be published instead of filling the disk.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        os.makedirs(self.root, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.cond = threading.Condition()
+        # Download archives of the output folders, read once: the output may be a slow drive
+        self.archives = {}
+
+    def reserve(self, nbytes):
+        """Wait for nbytes of room and return a fresh directory for one track."""
+        with self.cond:
+            if self.used and self.used + nbytes > self.max_bytes:
+                print(f"Scratch space full ({self.used // 1048576} MiB in use), waiting for earlier tracks to publish")
+                while self.used and self.used + nbytes > self.max_bytes:
+                    self.cond.wait()
+            self.used += nbytes
+        return tempfile.mkdtemp(prefix='track-', dir=self.root)
+
+    def archive(self, path):
+        """Contents of the download archive at path, read from disk only the first time."""
+        with self.cond:
+            if path not in self.archives:
+                with contextlib.suppress(FileNotFoundError), open(path, 'rb') as f:
+                    self.archives[path] = f.read()
+            return self.archives.setdefault(path, b'')
+
+    def add_to_archive(self, path, new_ids):
+        """Append newly published video IDs to the archive at path."""
+        with self.cond:
+            self.archive(path)
+            with open(path, 'ab') as f:
+                f.write(new_ids)
+            self.archives[path] += new_ids
+
+    def release(self, work_dir, nbytes):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+def open_scratch(config):
+    """The ScratchArea configured by scratch_dir, or None to work in the output folder."""
+    if not config.get('scratch_dir'):
+        return None
+    return ScratchArea(config['scratch_dir'], int(config.get('scratch_max_mb', 1024)) * 1048576)
+
+
+def publish_file(src, dest):
+    """Move a finished file to dest so that dest never exists half-written.
+
+    On the same filesystem this is a rename. Across filesystems the file is
+    copied next to dest under a hidden name first and then renamed into place.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.replace(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.publishing")
+    try:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    os.remove(src)
+
+
+FLAT_SEARCH_ARGS = ["--flat-playlist", "--dump-single-json", "--no-playlist"]
+# Extra timeout allowance per search in a bulk phase-1 call, on top of timeout_call
+BULK_SECONDS_PER_SEARCH = 2
+
+
+class ConversionEngine:
+    """Matches and downloads single CSV rows into an output folder.
+
+    This holds everything convert_playlist needs per row without touching Tk,
+    so the GUI, shard workers and other headless modes share one code path.
+    status is called with short progress strings.
+    """
+
+    def __init__(self, config, output_dir, ffmpeg_exe, yt_dlp_exe, playlist_name='',
+                 deep_search=True, transcode_mp3=False, embed_thumbnails=False,
+                 exclude_instrumentals=False, library=None, status=print, run_budget=None, query_cache=None,
+                 scratch=None, post_process=None):
+        self.config = config
+        self.output_dir = output_dir
+        self.ffmpeg_exe = ffmpeg_exe
+        self.yt_dlp_exe = yt_dlp_exe
+        self.playlist_name = playlist_name
+        self.deep_search = deep_search
+        self.transcode_mp3 = transcode_mp3
+        self.embed_thumbnails = embed_thumbnails
+        self.exclude_instrumentals = exclude_instrumentals
+        self.library = library
+        self.status = status
+        self.cookies_path = config.get('cookies_path')
+        self.duration_min = config.get("duration_min", 0)
+        self.duration_max = config.get("duration_max", float("inf"))
+        self.archive_file = os.path.join(output_dir, 'downloaded.txt')
+        self.creationflags = subprocess.CREATE_NO_WINDOW if platform.system() == 'Windows' else 0
+        # MP3-only players need MP3s; the M4A mode's players take either format
+        self.library_exts = ('.mp3',) if transcode_mp3 else AUDIO_EXTENSIONS
+        # 'smallest' trades a little bitrate for bytes: see pick_audio_format
+        self.format_policy = config.get('format_policy', 'best')
+        self.format_min_abr = config.get('format_min_abr', 96)
+        self.format_codecs = tuple(config.get('format_codecs') or ('mp4a', 'opus'))
+        self.probe_info = {}
+        self.bytes_saved = 0
+        self.layout = OutputLayout(config.get('output_shard', 'none'))
+        # Time budgets (seconds, 0 = none): per yt-dlp call, per track, per run
+        self.timeout_call = config.get('timeout_call', 60) or None
+        self.timeout_download = config.get('timeout_download', 900) or None
+        self.budget_track = config.get('budget_track', 90) or None
+        self.track_deadline = None
+        self.run_budget = run_budget
+        self.query_cache = query_cache if query_cache is not None else QueryCache()
+        self.bulk_window = config.get('bulk_window', 50)
+        self.bulk_calls = 0
+        # With a scratch area, downloads and post_process(i, path) happen there and
+        # only the finished file is written to output_dir (see publish)
+        self.scratch = scratch if scratch is not None else open_scratch(config)
+        self.post_process = post_process
+        self.staged = None
+
+    def yt_cmd(self, extra_args, search_spec):
+        """yt-dlp command line for one spec, or for a list of them."""
+        cmd = [self.yt_dlp_exe, f"--ffmpeg-location={os.path.dirname(self.ffmpeg_exe)}", "--no-config"]
+        if self.cookies_path: cmd += ["--cookies", self.cookies_path]
+        cmd += extra_args + (list(search_spec) if isinstance(search_spec, list) else [search_spec])
+        return cmd
+
+    def run_yt(self, extra_args, search_spec, timeout=None):
+        """Run yt-dlp on one spec (or a list of them). A timeout returns code -1 with whatever output was written."""
+        cmd = self.yt_cmd(extra_args, search_spec)
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, creationflags=self.creationflags, timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            what = f"{len(search_spec)} searches" if isinstance(search_spec, list) else search_spec
+            print(f"yt-dlp timed out after {timeout:.0f}s: {what}")
+            stdout = e.stdout.decode('utf-8', 'replace') if isinstance(e.stdout, bytes) else (e.stdout or '')
+            return subprocess.CompletedProcess(cmd, -1, stdout, f'Timed out after {timeout:.0f}s')
+
+    def start_run(self, total):
+        """Begin a run of total rows under the configured run budget. Returns the shared RunBudget."""
+        self.run_budget = RunBudget(self.config.get('budget_run', 0), total)
+        return self.run_budget
+
+    def start_track(self):
+        self.track_deadline = time.monotonic() + self.budget_track if self.budget_track else None
+
+    def track_time_left(self):
+        return None if self.track_deadline is None else self.track_deadline - time.monotonic()
+
+    def call_timeout(self):
+        """Timeout for the next search/probe call: the per-call limit, capped by what is left of the track budget."""
+        left = self.track_time_left()
+        if left is None:
+            return self.timeout_call
+        return max(1.0, min(self.timeout_call or left, left))
+
+    def fetch_json(self, extra_args, search_spec):
+        """Run yt-dlp and parse its JSON output. Returns (dict, stderr); the dict is empty on failure."""
+        key = (tuple(extra_args), search_spec)
+        cached = self.query_cache.get(key)
+        if cached is not None:
+            return cached
+        proc = self.run_yt(extra_args, search_spec, self.call_timeout())
+        try:
+            data = json.loads(proc.stdout) or {}
+        except Exception:
+            data = {}
+        result = (data if isinstance(data, dict) else {}), (proc.stderr or '')
+        if result[0] or 'Sign in to confirm your age' in result[1]:
+            self.query_cache.put(key, result)
+        return result
+
+    def prefetch_phase1(self, queries):
+        """Run the phase-1 ytsearch1: searches for many queries in one yt-dlp process.
+
+        Answers go into the query cache, where resolve() and plan_row() find
+        them. Specs yt-dlp gave no answer for are left to the per-row search.
+        Returns the number of queries resolved.
+        """
+        if not self.bulk_window:
+            return 0
+        specs = []
+        for q in queries:
+            spec = f"ytsearch1:{q}"
+            if spec not in specs and (tuple(FLAT_SEARCH_ARGS), spec) not in self.query_cache:
+                specs.append(spec)
+        if not specs:
+            return 0
+        # One call's limit plus a little per search, never past the end of the run budget
+        timeout = self.timeout_call + BULK_SECONDS_PER_SEARCH * len(specs) if self.timeout_call else None
+        run_left = self.run_budget.time_left() if self.run_budget is not None else None
+        if run_left is not None:
+            if run_left <= 1:
+                return 0
+            timeout = min(timeout or run_left, run_left)
+        self.bulk_calls += 1
+        proc = self.run_yt(FLAT_SEARCH_ARGS + ["--ignore-errors"], specs, timeout)
+
+        answers = []
+        for line in (proc.stdout or '').splitlines():
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(data, dict):
+                answers.append(data)
+        # One JSON line per spec that worked: match them up by the URL or query yt-dlp echoes back
+        resolved = {}
+        for data in answers:
+            spec = data.get('original_url') or data.get('webpage_url')
+            if spec not in specs:
+                spec = f"ytsearch1:{data.get('id') or data.get('title')}"
+            if spec in specs:
+                resolved[spec] = data
+        if not resolved and len(answers) == len(specs):
+            resolved = dict(zip(specs, answers))
+        for spec, data in resolved.items():
+            self.query_cache.put((tuple(FLAT_SEARCH_ARGS), spec), (data, ''), prefetched=True)
+        print(f"Bulk search: {len(resolved)}/{len(specs)} queries in one yt-dlp call")
+        return len(resolved)
+
+    def prefetch_rows(self, numbered_rows):
+        """Bulk-resolve the first search query of each (i, row) that the library will not supply."""
+        queries = []
+        for _i, row in numbered_rows:
+            title, artist_primary, _album, spotify_sec = row_fields(row, self.playlist_name)
+            if self.library is not None and self.library.lookup(title, artist_primary, spotify_sec, self.library_exts,
+                                                                exclude=self.output_dir):
+                continue
+            safe_title = re.sub(r"[^\w\s]", '', title)
+            queries.append(self.search_queries(title, safe_title, re.sub(r"[^\w\s]", '', artist_primary))[0][1])
+        return self.prefetch_phase1(queries)
+
+    def windows(self, rows, planning=False):
+        """Yield (i, row) with 1-based i, bulk-resolving each window of bulk_window rows before it is reached.
+
+        Only Deep Search and planning run a search of their own per row. A fast
+        conversion leaves the search to the download, so there is nothing to batch.
+        """
+        numbered = list(enumerate(rows, start=1))
+        for start, item in enumerate(numbered):
+            if self.bulk_window and start % self.bulk_window == 0 and (planning or self.deep_allowed()):
+                self.prefetch_rows(numbered[start:start + self.bulk_window])
+            yield item
+
+    def output_base(self, i, total, title, variant='', album=''):
+        """Path (relative to output_dir, without extension) for CSV row i."""
+        return self.layout.base(i, total, title, variant, album)
+
+    def link_from_library(self, i, total, title, artist_primary, album, spotify_sec):
+        owned = self.library.lookup(title, artist_primary, spotify_sec, self.library_exts, exclude=self.output_dir)
+        if not owned:
+            return None
+        dest = os.path.join(self.output_dir, self.output_base(i, total, title, album=album) + os.path.splitext(owned)[1].lower())
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        used = link_or_copy(owned, dest, self.config.get('library_link_mode', 'hardlink'))
+        # A hardlink shares the library file, so leave its tags alone
+        if used == 'copy':
+            tag_audio_file(dest, title, artist_primary, album, i)
+        print(f"Library match ({used}): {owned} → {dest}")
+        return dest
+
+    def resolve(self, i, total, q, variant, title, safe_title, safe_artist, spotify_sec, deep=None):
+        """Pick what to hand yt-dlp for one search query.
+
+        Returns a match dict: 'spec' (a video URL or ytsearch1: spec), 'phase'
+        ('fast', 'phase1', 'deep' or 'fallback') and, where known, 'video_id',
+        'score', 'duration_delta', 'runner_up' and 'runner_up_score'. When the
+        track budget cuts Deep Search short, 'degraded' says what was used instead.
+        """
+        if not (self.deep_search if deep is None else deep):
+            # A bulk-resolved search already knows its video, so the download need not search again
+            known, _ = self.query_cache.peek((tuple(FLAT_SEARCH_ARGS), f"ytsearch1:{q}")) or ({}, '')
+            entries_q = known.get('entries') if isinstance(known.get('entries'), list) else []
+            if entries_q and isinstance(entries_q[0], dict) and entries_q[0].get('id'):
+                vid = entries_q[0]['id']
+                return {'spec': f"https://www.youtube.com/watch?v={vid}", 'phase': 'fast', 'video_id': vid}
+            return {'spec': f"ytsearch1:{q}", 'phase': 'fast'}
+
+        duration_min, duration_max = self.duration_min, self.duration_max
+        # Phase 1: quick flat-playlist probe
+        data_q, _ = self.fetch_json(FLAT_SEARCH_ARGS, f"ytsearch1:{q}")
+        entries_q = data_q.get('entries') if isinstance(data_q.get('entries'), list) else []
+        top = entries_q[0] if entries_q else {}
+
+        vid_title = top.get('title', '')
+        upl = (top.get('uploader') or '').lower()
+        duration = top.get('duration') or 0
+        passes = (
+            safe_title.lower() in vid_title.lower()
+            and (not safe_artist or safe_artist.lower() in upl)
+            and (not spotify_sec or abs(duration - spotify_sec) <= 10)
+            and (duration >= duration_min and duration <= duration_max)
+        )
+        if passes:
+            return {'spec': top.get('webpage_url', f"https://www.youtube.com/watch?v={top.get('id','')}" ),
+                    'phase': 'phase1', 'video_id': top.get('id'),
+                    'duration_delta': round(abs(duration - spotify_sec), 1) if spotify_sec else None}
+
+        def out_of_time():
+            left = self.track_time_left()
+            return left is not None and left <= 0
+
+        def phase1_fallback():
+            # Phase 1's top result is already known, so the download need not search for it again
+            spec = f"https://www.youtube.com/watch?v={top['id']}" if top.get('id') else f"ytsearch1:{q}"
+            return {'spec': spec, 'phase': 'fallback', 'video_id': top.get('id')}
+
+        if out_of_time():
+            return {**phase1_fallback(), 'degraded': 'track budget: phase-1 result'}
+
+        print("Deep searching : " + title)
+        # Phase 2: deep-search candidate IDs
+        data_ids, _ = self.fetch_json(FLAT_SEARCH_ARGS, f"ytsearch3:{q}")
+        entries_ids = data_ids.get('entries') if isinstance(data_ids.get('entries'), list) else []
+        ids = [e for e in entries_ids if isinstance(e, dict)][:3]
+
+        scored = []
+        cut_short = False
+        first_words = normalize_text(title).split()[:5]
+        for entry in ids:
+            if out_of_time():
+                cut_short = True
+                break
+            vid = entry.get('id')
+            url = f"https://www.youtube.com/watch?v={vid}"
+            info, stderr = self.fetch_json(["--dump-single-json", "--no-playlist"], url)
+            if "Sign in to confirm your age" in stderr or not info:
+                continue
+
+            raw_title = info.get('title','')
+            low = raw_title.lower()
+            up2 = (info.get('uploader') or '').lower()
+            dur2 = info.get('duration') or 0
+            # enforce duration bounds
+            if dur2 < duration_min or dur2 > duration_max:
+                continue
+            if 'shorts/' in info.get('webpage_url','') or '#shorts' in low: continue
+            if safe_artist.lower() and safe_artist.lower() not in up2: continue
+            if variant and variant.lower() not in low: continue
+            if not contains_keywords_in_order(raw_title, first_words): continue
+            score = 100 if low.startswith(safe_title.lower()) else 80
+            if spotify_sec: score -= abs(dur2 - spotify_sec)
+            self.probe_info[url] = info
+            scored.append((score, url, vid, round(abs(dur2 - spotify_sec), 1) if spotify_sec else None))
+
+        if not scored:
+            match = phase1_fallback()
+            if cut_short:
+                match['degraded'] = 'track budget: phase-1 result'
+            return match
+        scored.sort(key=lambda x: x[0], reverse=True)
+        score, url, vid, delta = scored[0]
+        match = {'spec': url, 'phase': 'deep', 'video_id': vid, 'score': round(score, 1), 'duration_delta': delta}
+        if len(scored) > 1:
+            match['runner_up'] = scored[1][2]
+            match['runner_up_score'] = round(scored[1][0], 1)
+        if cut_short:
+            match['degraded'] = f'track budget: best of {len(scored)} probed candidates'
+        return match
+
+    def download(self, download_spec, base):
+        """Download download_spec to base + extension. Returns (path or None, stderr)."""
+        fmt_spec, chosen = self.choose_format(download_spec)
+        if self.scratch is not None:
+            self.discard_staged()
+            size = format_bytes(chosen, (self.probe_info.get(download_spec) or {}).get('duration')) if chosen else None
+            # The stream, the converted file and a cover-art copy can all exist at once
+            nbytes = 3 * size if size else SCRATCH_TRACK_BYTES
+            work_dir = self.scratch.reserve(nbytes)
+            # yt-dlp records into a scratch copy of the archive; publish() adds the new ID to the real one
+            archive = os.path.join(work_dir, 'downloaded.txt')
+            known = self.scratch.archive(self.archive_file)
+            with open(archive, 'wb') as f:
+                f.write(known)
+            self.staged = (work_dir, nbytes, len(known))
+            out_base = os.path.join(work_dir, os.path.basename(base))
+        else:
+            archive = self.archive_file
+            out_base = os.path.join(self.output_dir, base)
+            os.makedirs(os.path.dirname(out_base), exist_ok=True)
+        cmd_dl = [
+            '--download-archive', archive,
+            '-f', fmt_spec,
+            '--output', out_base + ".%(ext)s",
+            '--no-playlist'
+        ]
+        if self.embed_thumbnails: cmd_dl += ['--embed-thumbnail','--add-metadata']
+        # Skip the ffmpeg pass when the chosen stream already is the output format
+        if self.transcode_mp3:
+            if not (chosen and (chosen.get('acodec') or '').startswith('mp3')):
+                cmd_dl += ['--extract-audio','--audio-format','mp3','--audio-quality','0']
+        elif not (chosen and chosen.get('ext') == 'm4a'):
+            cmd_dl += ['--remux-video','m4a']
+        if self.exclude_instrumentals: cmd_dl += ['--reject-title','instrumental']
+
+        ret = self.run_yt(cmd_dl, download_spec, self.timeout_download)
+        if ret.returncode != 0:
+            self.discard_staged()
+            return None, ret.stderr or f'yt-dlp exited with code {ret.returncode}'
+        out_ext = '.mp3' if self.transcode_mp3 else '.m4a'
+        candidate_path = out_base + out_ext
+        if not os.path.isfile(candidate_path):
+            self.discard_staged()
+            # An archive skip: the file from an earlier run is already in place
+            published = os.path.join(self.output_dir, base + out_ext)
+            return (published if os.path.isfile(published) else None), ''
+        return candidate_path, ''
+
+    def discard_staged(self):
+        """Free the scratch space of a track that will not be published."""
+        if self.staged is not None:
+            work_dir, nbytes, _archived = self.staged
+            self.staged = None
+            self.scratch.release(work_dir, nbytes)
+
+    def publish(self, i, path, base):
+        """Put a downloaded, tagged file in its place under output_dir. Returns the final path.
+
+        A file downloaded to scratch gets post_process there, then lands in
+        output_dir with one atomic rename (or copy + rename across filesystems).
+        """
+        if self.staged is None:
+            return path
+        try:
+            if self.post_process is not None:
+                self.post_process(i, path)
+            dest = os.path.join(self.output_dir, base + os.path.splitext(path)[1])
+            publish_file(path, dest)
+            # Only a published file counts as downloaded, so a crash before this point retries the video
+            work_dir, _nbytes, archived = self.staged
+            new_ids = b''
+            if os.path.isfile(os.path.join(work_dir, 'downloaded.txt')):
+                with open(os.path.join(work_dir, 'downloaded.txt'), 'rb') as f:
+                    f.seek(archived)
+                    new_ids = f.read()
+            if new_ids:
+                self.scratch.add_to_archive(self.archive_file, new_ids)
+            return dest
+        finally:
+            self.discard_staged()
+
+    def choose_format(self, download_spec):
+        """yt-dlp -f value for a download, plus the format dict when it was picked from a probed list."""
+        if self.format_policy != 'smallest':
+            return DEFAULT_AUDIO_FORMAT, None
+        info = self.probe_info.get(download_spec) or {}
+        formats = info.get('formats')
+        duration = info.get('duration')
+        chosen = pick_audio_format(formats, duration, self.transcode_mp3, self.format_min_abr, self.format_codecs)
+        if not chosen:
+            return audio_format_selector(self.transcode_mp3, self.format_min_abr, self.format_codecs), None
+
+        default = default_audio_format(formats)
+        saved = (format_bytes(default, duration) or 0) - format_bytes(chosen, duration) if default else 0
+        self.bytes_saved += max(saved, 0)
+        print(f"Format {chosen['format_id']} ({chosen.get('acodec')}, {chosen.get('abr')} kbps, "
+              f"{format_bytes(chosen, duration) // 1024} KiB): saved {max(saved, 0) // 1024} KiB "
+              f"vs {default['format_id'] if default else 'default'}")
+        return chosen['format_id'], chosen
+
+    def search_queries(self, title, safe_title, safe_artist):
+        """[(variant, search query)] to try for a row, in order, without duplicate queries."""
+        variants = list(self.config.get('variants') or [''])
+        if 'instrumental' in title.lower():
+            variants.insert(0, 'instrumental')
+
+        queries, seen = [], set()
+        for variant in variants:
+            parts = [safe_title]
+            if safe_artist and safe_artist.lower() != 'unknown': parts.append(safe_artist)
+            if variant: parts.append(variant)
+            q = ' '.join(parts)
+            if q.lower() in seen:
+                continue
+            seen.add(q.lower())
+            queries.append((variant, q))
+        return queries
+
+    def deep_allowed(self):
+        """False once the run budget has pushed the rest of the run into fast mode."""
+        if self.run_budget is not None and self.run_budget.under_pressure():
+            return False
+        return self.deep_search
+
+    def match_row(self, i, row, total=1):
+        """Resolve a row's first search query without downloading. Returns (variant, query, match dict)."""
+        title, artist_primary, _album, spotify_sec = row_fields(row, self.playlist_name)
+        safe_artist = re.sub(r"[^\w\s]", '', artist_primary)
+        safe_title = re.sub(r"[^\w\s]", '', title)
+        variant, q = self.search_queries(title, safe_title, safe_artist)[0]
+        match = self.resolve(i, total, q, variant, title, safe_title, safe_artist, spotify_sec, self.deep_allowed())
+        if self.deep_search and match['phase'] == 'fast':
+            match['degraded'] = 'run budget: fast mode'
+        return variant, q, match
+
+    def convert_row(self, i, row, total):
+        """Match, download and tag CSV row number i.
+
+        Returns a dict with 'file' (path relative to output_dir, or None),
+        'not_found' (a not-found CSV record, or None) and 'degraded' (a
+        budget report record when a time budget cut the search short, or None).
+        """
+        try:
+            return self._convert_row(i, row, total)
+        finally:
+            self.discard_staged()
+            if self.run_budget is not None:
+                self.run_budget.row_done()
+
+    def _convert_row(self, i, row, total):
+        title, artist_primary, album, spotify_sec = row_fields(row, self.playlist_name)
+        safe_artist = re.sub(r"[^\w\s]", '', artist_primary)
+        safe_title = re.sub(r"[^\w\s]", '', title)
+        self.probe_info.clear()
+        self.start_track()
+        deep = self.deep_allowed()
+        run_degraded = 'run budget: fast mode' if self.deep_search and not deep else None
+
+        def not_found(error):
+            return {'file': None, 'degraded': None,
+                    'not_found': {'Track Name':title,'Artist Name(s)':artist_primary,'Album Name':album,'Track Number':i,'Error':error}}
+
+        if self.library is not None:
+            owned = self.link_from_library(i, total, title, artist_primary, album, spotify_sec)
+            if owned:
+                self.status(f"[{i}/{total}] From library: {title}")
+                return {'file': os.path.relpath(owned, self.output_dir), 'not_found': None, 'degraded': None}
+
+        for variant, q in self.search_queries(title, safe_title, safe_artist):
+            print(f"Searching for → {q!r}")
+            self.status(f"[{i}/{total}] Searching: {q}")
+
+            match = self.resolve(i, total, q, variant, title, safe_title, safe_artist, spotify_sec, deep)
+            download_spec = match['spec']
+            # Only this variant's own cut-short counts; a failed earlier variant's does not carry over
+            degraded = match.get('degraded') or run_degraded
+            if match.get('degraded'):
+                print(f"Out of time for {title!r}: {degraded}")
+
+            # Download
+            base = self.output_base(i, total, title, variant, album)
+            best_file, stderr = self.download(download_spec, base)
+            if stderr:
+                if 'Sign in to confirm your age' in stderr:
+                    return not_found('Age-restricted video')
+                print(f"Download failed for {download_spec}: {stderr[:200]}")
+                continue
+            if best_file:
+                tag_audio_file(best_file, title, artist_primary, album, i if self.transcode_mp3 else None)
+                best_file = self.publish(i, best_file, base)
+                report = None
+                if degraded:
+                    report = {'Track Number': i, 'Track Name': title, 'Artist Name(s)': artist_primary, 'Fallback': degraded}
+                return {'file': os.path.relpath(best_file, self.output_dir), 'not_found': None, 'degraded': report}
+
+        return not_found('No valid download')
+
+    def plan_row(self, i, row, total=1):
+        """Resolve a row to a plan entry (see write_plan) without downloading anything."""
+        self.probe_info.clear()
+        self.start_track()
+        try:
+            variant, q, match = self.match_row(i, row, total)
+        finally:
+            if self.run_budget is not None:
+                self.run_budget.row_done()
+        if match['phase'] == 'fast':
+            # Fast mode leaves the pick to the download; run its search now to pin the video
+            data_q, _ = self.fetch_json(FLAT_SEARCH_ARGS, f"ytsearch1:{q}")
+            entries_q = data_q.get('entries') if isinstance(data_q.get('entries'), list) else []
+            top = entries_q[0] if entries_q and isinstance(entries_q[0], dict) else {}
+            spotify_sec = row_fields(row, self.playlist_name)[3]
+            match['video_id'] = top.get('id')
+            if spotify_sec and top.get('duration'):
+                match['duration_delta'] = round(abs(top['duration'] - spotify_sec), 1)
+
+        entry = {'n': i, 'row': row, 'variant': variant, 'query': q}
+        entry.update({k: match.get(k) for k in PLAN_MATCH_FIELDS if k == 'video_id' or match.get(k) is not None})
+        info = self.probe_info.get(match['spec'])
+        if info and info.get('formats'):
+            entry['duration'] = info.get('duration')
+            entry['formats'] = compact_formats(info['formats'])
+            # Format IDs only apply to the video they were probed for; execute drops them if video_id is edited
+            entry['formats_video_id'] = info.get('id') or match.get('video_id')
+        return entry
+
+    def execute_row(self, entry, total):
+        """Download a plan entry's video with no search calls. Returns the same dict as convert_row."""
+        try:
+            return self._execute_row(entry, total)
+        finally:
+            self.discard_staged()
+
+    def _execute_row(self, entry, total):
+        i, row = entry['n'], entry['row']
+        title, artist_primary, album, spotify_sec = row_fields(row, self.playlist_name)
+        self.probe_info.clear()
+
+        def not_found(error):
+            return {'file': None, 'not_found': {'Track Name':title,'Artist Name(s)':artist_primary,'Album Name':album,'Track Number':i,'Error':error}}
+
+        if self.library is not None:
+            owned = self.link_from_library(i, total, title, artist_primary, album, spotify_sec)
+            if owned:
+                self.status(f"[{i}/{total}] From library: {title}")
+                return {'file': os.path.relpath(owned, self.output_dir), 'not_found': None}
+
+        vid = entry.get('video_id')
+        if not vid:
+            return not_found('No match in plan')
+        url = f"https://www.youtube.com/watch?v={vid}"
+        if entry.get('formats') and entry.get('formats_video_id') == vid:
+            self.probe_info[url] = {'formats': entry['formats'], 'duration': entry.get('duration')}
+        self.status(f"[{i}/{total}] Downloading: {title}")
+        base = self.output_base(i, total, title, entry.get('variant') or '', album)
+        best_file, stderr = self.download(url, base)
+        if stderr:
+            print(f"Download failed for {url}: {stderr[:200]}")
+            return not_found('Age-restricted video' if 'Sign in to confirm your age' in stderr else 'Download failed')
+        if not best_file:
+            return not_found('No valid download')
+        tag_audio_file(best_file, title, artist_primary, album, i if self.transcode_mp3 else None)
+        best_file = self.publish(i, best_file, base)
+        report = None
+        if entry.get('degraded'):
+            report = {'Track Number': i, 'Track Name': title, 'Artist Name(s)': artist_primary, 'Fallback': entry['degraded']}
+        return {'file': os.path.relpath(best_file, self.output_dir), 'not_found': None, 'degraded': report}
+
+
+PLAN_VERSION = 1
+PLAN_MATCH_FIELDS = ('video_id', 'phase', 'score', 'runner_up', 'runner_up_score', 'duration_delta', 'degraded')
+
+
+def compact_formats(formats):
+    """The audio-only formats of a probe, reduced to what pick_audio_format needs."""
+    keys = ('format_id', 'ext', 'acodec', 'vcodec', 'abr', 'filesize', 'filesize_approx')
+    return [{k: f[k] for k in keys if f.get(k) is not None} for f in audio_only_formats(formats)]
+
+
+def write_plan(path, playlist_name, entries, deep_search=True):
+    """Write a match plan: one JSON object per line inside a JSON document, so it diffs and edits well.
+
+    Plans hold the CSV rows themselves and no output settings, so the same
+    plan can be executed on another machine or into another format.
+    """
+    header = {'version': PLAN_VERSION, 'playlist_name': playlist_name,
+              'mode': 'deep' if deep_search else 'fast', 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header, ensure_ascii=False)[:-1] + ', "rows": [\n')
+        f.write(',\n'.join(json.dumps(e, ensure_ascii=False) for e in entries))
+        f.write('\n]}\n')
+
+
+def load_plan(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version: {plan.get('version')}")
+    return plan
+
+
+def build_plan(engine, csv_path, plan_path):
+    """Match every row of a CSV and write the plan. Returns the plan entries."""
+    rows = read_csv_rows(csv_path)
+    engine.start_run(len(rows))
+    entries = []
+    for i, row in engine.windows(rows, planning=True):
+        entries.append(engine.plan_row(i, row, len(rows)))
+    write_plan(plan_path, engine.playlist_name, entries, engine.deep_search)
+    return entries
+
+
+def execute_plan(engine, plan, generate_m3u=True):
+    """Download every row of a plan into engine.output_dir. Returns (files, not-found records)."""
+    rows = plan['rows']
+    files, not_found, degraded = [], [], []
+    for entry in rows:
+        result = engine.execute_row(entry, len(rows))
+        if result['file']:
+            files.append(result['file'])
+        else:
+            not_found.append(result['not_found'])
+        if result.get('degraded'):
+            degraded.append(result['degraded'])
+    if not_found:
+        write_not_found_csv(engine.output_dir, engine.playlist_name, not_found)
+    if degraded:
+        write_budget_report(engine.output_dir, engine.playlist_name, degraded)
+    if generate_m3u:
+        write_m3u(engine.output_dir, engine.playlist_name, files)
+    return files, not_found
+
+
+SHARD_JOB_OPTIONS = ('deep_search', 'transcode_mp3', 'embed_thumbnails', 'exclude_instrumentals')
+SHARD_JOB_CONFIG_KEYS = ('variants', 'duration_min', 'duration_max', 'format_policy', 'format_min_abr', 'format_codecs',
+                         'output_shard', 'timeout_call', 'timeout_download', 'budget_track', 'bulk_window')
+
+
+class ShardQueue:
+    """Lease-based work queue for splitting one CSV across worker processes.
+
+    Every CSV row is a work item stored in a SQLite file. Workers claim items
+    for lease_seconds and renew the lease while they work. A lease that is not
+    renewed in time (the worker died) is handed to the next claimer. An item
+    whose leases expire max_attempts times is marked failed. Items keep their
+    CSV row number, so file numbering matches a single-process run.
+    """
+
+    def __init__(self, path, lease_seconds=300, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @classmethod
+    def create(cls, path, csv_path, output_dir, options, plan=None, **kwargs):
+        """Queue every row of csv_path, or every entry of a loaded plan (csv_path is then ignored)."""
+        if plan is not None:
+            playlist_name = plan['playlist_name']
+            items = [(e['n'], e) for e in plan['rows']]
+            options = {**options, 'plan': True}
+        else:
+            playlist_name = os.path.splitext(os.path.basename(csv_path))[0]
+            items = list(enumerate(read_csv_rows(csv_path), start=1))
+        queue = cls(path, **kwargs)
+        db = queue._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("""CREATE TABLE IF NOT EXISTS items (
+                idx INTEGER PRIMARY KEY, row TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending', worker TEXT,
+                lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT)""")
+            db.execute("DELETE FROM items")
+            job = {
+                'playlist_name': playlist_name,
+                'output_dir': os.path.abspath(os.path.join(output_dir, playlist_name)),
+                'total': len(items),
+                'options': options,
+            }
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('job', ?)", (json.dumps(job),))
+            db.executemany("INSERT INTO items (idx, row) VALUES (?, ?)",
+                           [(i, json.dumps(row)) for i, row in items])
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return queue
+
+    def job(self):
+        db = self._connect()
+        try:
+            return json.loads(db.execute("SELECT value FROM meta WHERE key='job'").fetchone()[0])
+        finally:
+            db.close()
+
+    def claim(self, worker, n=1):
+        """Lease up to n pending (or abandoned) items. Returns [(row number, row dict)]."""
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("""UPDATE items SET state='failed', worker=NULL, result=?
+                          WHERE state='leased' AND lease_until < ? AND attempts >= ?""",
+                       (json.dumps({'file': None, 'error': 'Lease expired too often'}), now, self.max_attempts))
+            picked = db.execute("""SELECT idx, row FROM items
+                                   WHERE state='pending' OR (state='leased' AND lease_until < ?)
+                                   ORDER BY idx LIMIT ?""", (now, n)).fetchall()
+            db.executemany("UPDATE items SET state='leased', worker=?, lease_until=?, attempts=attempts+1 WHERE idx=?",
+                           [(worker, now + self.lease_seconds, idx) for idx, _ in picked])
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return [(idx, json.loads(row)) for idx, row in picked]
+
+    def renew(self, worker, indexes):
+        """Extend the worker's leases. Returns the row numbers it still holds."""
+        if not indexes:
+            return []
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            marks = ','.join('?' * len(indexes))
+            db.execute(f"UPDATE items SET lease_until=? WHERE worker=? AND state='leased' AND idx IN ({marks})",
+                       (time.time() + self.lease_seconds, worker, *indexes))
+            held = [r[0] for r in db.execute(
+                f"SELECT idx FROM items WHERE worker=? AND state='leased' AND idx IN ({marks})", (worker, *indexes))]
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return held
+
+    def complete(self, worker, index, result):
+        """Store a row's result. Returns False if the lease had already been lost."""
+        db = self._connect()
+        try:
+            cur = db.execute("UPDATE items SET state='done', result=?, lease_until=NULL WHERE idx=? AND worker=? AND state='leased'",
+                             (json.dumps(result), index, worker))
+            return cur.rowcount == 1
+        finally:
+            db.close()
+
+    def fail(self, worker, index, error):
+        """Give an item back after an unexpected error, or fail it for good after max_attempts."""
+        db = self._connect()
+        try:
+            cur = db.execute("""UPDATE items SET
+                                state=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                worker=NULL, lease_until=NULL, result=?
+                                WHERE idx=? AND worker=? AND state='leased'""",
+                             (self.max_attempts, json.dumps({'file': None, 'error': str(error)}), index, worker))
+            return cur.rowcount == 1
+        finally:
+            db.close()
+
+    def status(self):
+        db = self._connect()
+        try:
+            counts = dict(db.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+        finally:
+            db.close()
+        return {state: counts.get(state, 0) for state in ('pending', 'leased', 'done', 'failed')}
+
+    def results(self):
+        """[(row number, row, state, result)] in CSV order."""
+        db = self._connect()
+        try:
+            return [(idx, json.loads(row), state, json.loads(result) if result else None)
+                    for idx, row, state, result in db.execute("SELECT idx, row, state, result FROM items ORDER BY idx")]
+        finally:
+            db.close()
+
+
+class ShardCoordinatorHandler(BaseHTTPRequestHandler):
+    """JSON-over-HTTP front end for a ShardQueue, for workers on other machines."""
+
+    queue = None
+
+    def _reply(self, payload, code=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/job':
+            # Workers renew at a third of the coordinator's lease, not their own --lease
+            self._reply({**self.queue.job(), 'lease_seconds': self.queue.lease_seconds})
+        elif self.path == '/status':
+            self._reply(self.queue.status())
+        elif self.path == '/results':
+            self._reply({'results': self.queue.results()})
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if self.path == '/claim':
+                self._reply({'items': self.queue.claim(req['worker'], int(req.get('n', 1)))})
+            elif self.path == '/renew':
+                self._reply({'held': self.queue.renew(req['worker'], req.get('indexes', []))})
+            elif self.path == '/complete':
+                self._reply({'ok': self.queue.complete(req['worker'], req['index'], req['result'])})
+            elif self.path == '/fail':
+                self._reply({'ok': self.queue.fail(req['worker'], req['index'], req.get('error', ''))})
+            else:
+                self._reply({'error': 'not found'}, 404)
+        except Exception as e:
+            self._reply({'error': str(e)}, 400)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_shard_queue(queue, host='127.0.0.1', port=8765):
+    handler = type('BoundShardCoordinatorHandler', (ShardCoordinatorHandler,), {'queue': queue})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Shard coordinator for {queue.path} listening on http://{host}:{server.server_port}")
+    return server
+
+
+class RemoteShardQueue:
+    """Client for serve_shard_queue with the same claim/renew/complete/fail API as ShardQueue."""
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.lease_seconds = None
+
+    def _call(self, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        req = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.loads(resp.read())
+
+    def job(self):
+        job = self._call('/job')
+        self.lease_seconds = job.pop('lease_seconds', self.lease_seconds)
+        return job
+
+    def status(self):
+        return self._call('/status')
+
+    def results(self):
+        return [tuple(r) for r in self._call('/results')['results']]
+
+    def claim(self, worker, n=1):
+        return [(idx, row) for idx, row in self._call('/claim', {'worker': worker, 'n': n})['items']]
+
+    def renew(self, worker, indexes):
+        return self._call('/renew', {'worker': worker, 'indexes': list(indexes)})['held']
+
+    def complete(self, worker, index, result):
+        return self._call('/complete', {'worker': worker, 'index': index, 'result': result})['ok']
+
+    def fail(self, worker, index, error):
+        return self._call('/fail', {'worker': worker, 'index': index, 'error': str(error)})['ok']
+
+
+def open_shard_queue(spec, **kwargs):
+    """A queue from a SQLite path or an http:// coordinator URL."""
+    if spec.startswith(('http://', 'https://')):
+        return RemoteShardQueue(spec)
+    return ShardQueue(spec, **kwargs)
+
+
+def run_shard_worker(queue, worker_id=None, output_dir=None, batch=1, poll_seconds=5, renew_seconds=None):
+    """Claim and convert rows until the queue has nothing left. Returns the number of rows processed.
+
+    Leases are renewed every renew_seconds, by default a third of the queue's
+    lease length (for a remote queue, the coordinator's).
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    job = queue.job()
+    if renew_seconds is None:
+        renew_seconds = max(1, (queue.lease_seconds or 300) // 3)
+    options = job.get('options', {})
+    config = {**load_config(), **options.get('config', {})}
+    output_dir = output_dir or job['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+
+    ffmpeg_exe, yt_dlp_exe = find_tools(config)
+    missing = missing_tools(ffmpeg_exe, yt_dlp_exe)
+    if missing:
+        raise RuntimeError(f"{', '.join(missing)} not found. Please install.")
+
+    engine = ConversionEngine(
+        config, output_dir, ffmpeg_exe, yt_dlp_exe, playlist_name=job['playlist_name'],
+        library=open_library(config),
+        status=lambda text: print(f"[{worker_id}] {text}"),
+        **{k: bool(options.get(k)) for k in SHARD_JOB_OPTIONS}
+    )
+
+    held = set()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(renew_seconds):
+            try:
+                lost = set(held) - set(queue.renew(worker_id, sorted(held)))
+                if lost:
+                    print(f"[{worker_id}] Lost leases on rows {sorted(lost)}")
+            except Exception as e:
+                print(f"[{worker_id}] Lease renewal failed: {e}")
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    processed = 0
+    try:
+        while True:
+            items = queue.claim(worker_id, batch)
+            if not items:
+                counts = queue.status()
+                if not counts['pending'] and not counts['leased']:
+                    break
+                # Another worker still holds leases; wait in case it dies
+                stop.wait(poll_seconds)
+                continue
+            held.update(idx for idx, _ in items)
+            if not options.get('plan') and len(items) > 1 and engine.deep_allowed():
+                engine.prefetch_rows(items)
+            for idx, row in items:
+                try:
+                    if options.get('plan'):
+                        result = engine.execute_row(row, job['total'])
+                    else:
+                        result = engine.convert_row(idx, row, job['total'])
+                    if not queue.complete(worker_id, idx, result):
+                        print(f"[{worker_id}] Row {idx} finished after its lease was lost")
+                except Exception as e:
+                    print(f"[{worker_id}] Row {idx} failed: {e}")
+                    queue.fail(worker_id, idx, e)
+                held.discard(idx)
+                processed += 1
+    finally:
+        stop.set()
+    if engine.query_cache.saved:
+        print(f"[{worker_id}] Query planner saved {engine.query_cache.saved} searches")
+    return processed
+
+
+def finalize_shard_job(queue, output_dir=None, generate_m3u=True):
+    """Write the not-found CSV and M3U for a finished shard job, in CSV order."""
+    job = queue.job()
+    output_dir = output_dir or job['output_dir']
+    from_plan = job.get('options', {}).get('plan')
+    files, not_found, degraded = [], [], []
+    for idx, row, state, result in queue.results():
+        result = result or {}
+        if from_plan:
+            row = row['row']
+        if result.get('degraded'):
+            degraded.append(result['degraded'])
+        if state == 'done' and result.get('file'):
+            files.append(result['file'])
+        elif result.get('not_found'):
+            not_found.append(result['not_found'])
+        else:
+            title, artist_primary, album, _ = row_fields(row, job['playlist_name'])
+            not_found.append({'Track Name':title,'Artist Name(s)':artist_primary,'Album Name':album,'Track Number':idx,
+                              'Error':result.get('error') or f'Not processed ({state})'})
+    if not_found:
+        write_not_found_csv(output_dir, job['playlist_name'], not_found)
+    if degraded:
+        write_budget_report(output_dir, job['playlist_name'], degraded)
+    if generate_m3u:
+        write_m3u(output_dir, job['playlist_name'], files)
+    return files, not_found
+
+TRACK_FILE_RE = re.compile(r'^(\d+) - ')
+
+
+def wanted_tags(path, i, row, playlist_name):
+    """The tags convert_playlist would have written for row i into path."""
+    title, artist_primary, album, _ = row_fields(row, playlist_name)
+    wanted = {'title': title, 'artist': artist_primary, 'album': album}
+    if path.lower().endswith('.mp3'):
+        wanted['tracknumber'] = str(i)
+    return wanted
+
+
+def read_tags(path):
+    audio = mutagen.File(path, easy=True)
+    tags = (audio.tags if audio is not None else None) or {}
+    found = {k: (tags.get(k) or [''])[0] for k in ('title', 'artist', 'album', 'tracknumber')}
+    found['tracknumber'] = found['tracknumber'].split('/')[0]
+    return found
+
+
+def retag_file(task):
+    """Bring one file's tags in line. task is (path, wanted, dry_run); returns (path, status, detail)."""
+    path, wanted, dry_run = task
+    try:
+        current = read_tags(path)
+        diff = {k: (current.get(k, ''), v) for k, v in wanted.items() if current.get(k, '') != v}
+        if not diff:
+            return path, 'unchanged', None
+        if not dry_run:
+            tag_audio_file(path, wanted['title'], wanted['artist'], wanted['album'], wanted.get('tracknumber'))
+        return path, 'changed', diff
+    except Exception as e:
+        return path, 'error', str(e)
+
+
+def retag_folder(csv_path, folder, workers=None, dry_run=False, include_links=False):
+    """Rewrite tags of an existing output folder from its CSV, without downloading or running ffmpeg.
+
+    Files are matched to rows by their 'NNN - ' track-number prefix and only
+    files whose tags differ are written. Hardlinked files are skipped unless
+    include_links is set, since they share tags with the library copy.
+    Returns a dict of counts plus the per-file changes.
+    """
+    playlist_name = os.path.splitext(os.path.basename(csv_path))[0]
+    rows = read_csv_rows(csv_path)
+    stats = {'files': 0, 'changed': 0, 'unchanged': 0, 'linked': 0, 'no_row': 0, 'error': 0, 'changes': {}}
+
+    tasks = []
+    # Walk subfolders too, for layouts sharded by hundreds or album
+    for dirpath, _dirs, names in os.walk(folder):
+        for name in names:
+            m = TRACK_FILE_RE.match(name)
+            if not m or not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            stats['files'] += 1
+            i = int(m.group(1))
+            if not 1 <= i <= len(rows):
+                stats['no_row'] += 1
+                continue
+            if not include_links and os.stat(path).st_nlink > 1:
+                stats['linked'] += 1
+                continue
+            tasks.append((path, wanted_tags(path, i, rows[i - 1], playlist_name), dry_run))
+
+    if tasks:
+        # Tag parsing is CPU-bound Python, so use processes rather than threads
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for path, status, detail in pool.map(retag_file, tasks, chunksize=max(1, len(tasks) // ((workers or os.cpu_count() or 1) * 4))):
+                stats[status] += 1
+                if status != 'unchanged':
+                    stats['changes'][os.path.relpath(path, folder)] = detail
+    return stats
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+def is_watchable_csv(name):
+    # Our own not-found reports must not feed back into the queue
+    return name.lower().endswith('.csv') and not name.endswith('_not_found.csv') and not name.startswith('.')
+
+
+class DirectoryWatcher:
+    """Reports CSV files that are created, rewritten or moved into a directory.
+
+    Uses inotify on Linux and falls back to polling directory snapshots
+    elsewhere (or when inotify is unavailable, e.g. on some network mounts).
+    A polled file is only reported once its size and mtime stay the same for
+    one interval, so a half-copied CSV is not picked up.
+    """
+
+    def __init__(self, path, poll_seconds=2.0, use_inotify=True):
+        self.path = os.path.abspath(path)
+        self.poll_seconds = poll_seconds
+        self.fd = self._inotify_fd() if use_inotify and sys.platform.startswith('linux') else None
+        self.mode = 'inotify' if self.fd is not None else 'polling'
+
+    def _inotify_fd(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, self.path.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except Exception as e:
+            print(f"inotify unavailable, polling instead: {e}")
+            return None
+
+    def _snapshot(self):
+        snap = {}
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if entry.is_file() and is_watchable_csv(entry.name):
+                        st = entry.stat()
+                        snap[entry.path] = (st.st_mtime, st.st_size)
+        except OSError as e:
+            print(f"Cannot list {self.path}: {e}")
+        return snap
+
+    def existing(self):
+        return self._snapshot()
+
+    def watch(self, callback, stop):
+        """Call callback(path) for each new or changed CSV until stop is set."""
+        if self.fd is not None:
+            self._watch_inotify(callback, stop)
+        else:
+            self._watch_polling(callback, stop)
+
+    def _watch_inotify(self, callback, stop):
+        header = struct.Struct('iIII')
+        try:
+            while not stop.is_set():
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if not ready:
+                    continue
+                try:
+                    buf = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                pos = 0
+                while pos + header.size <= len(buf):
+                    _wd, _mask, _cookie, length = header.unpack_from(buf, pos)
+                    name = buf[pos + header.size:pos + header.size + length].rstrip(b'\0').decode('utf-8', 'replace')
+                    pos += header.size + length
+                    if is_watchable_csv(name):
+                        callback(os.path.join(self.path, name))
+        finally:
+            os.close(self.fd)
+
+    def _watch_polling(self, callback, stop):
+        seen = self._snapshot()
+        settling = {}
+        while not stop.wait(self.poll_seconds):
+            snap = self._snapshot()
+            for path, sig in snap.items():
+                if seen.get(path) == sig:
+                    settling.pop(path, None)
+                elif settling.get(path) == sig:
+                    # Unchanged for a full interval: the copy has finished
+                    seen[path] = sig
+                    del settling[path]
+                    callback(path)
+                else:
+                    settling[path] = sig
+            for path in list(seen):
+                if path not in snap:
+                    del seen[path]
+
+
+class WatchService:
+    """Long-running watch-folder mode that keeps its engine state warm between jobs.
+
+    Tool paths, config, the library index and a pool of row workers are set
+    up once. Each CSV that lands in watch_dir becomes a job, converted into
+    output_root/<playlist name> like the GUI does. Jobs run one at a time and
+    their rows are spread over the pool. A small JSON status endpoint reports
+    queue depth, in-flight tracks and throughput.
+    """
+
+    STATE_FILE = '.spotify2mp3-watch.json'
+
+    def __init__(self, watch_dir, output_root, config, options, workers=4, poll=False):
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_root = os.path.abspath(output_root)
+        self.config = config
+        self.options = options
+        self.ffmpeg_exe, self.yt_dlp_exe = find_tools(config)
+        missing = missing_tools(self.ffmpeg_exe, self.yt_dlp_exe)
+        if missing:
+            raise RuntimeError(f"{', '.join(missing)} not found. Please install.")
+        self.library = open_library(config)
+        self.library_scanned = time.time()
+        # One bounded scratch area for all row workers
+        self.scratch = open_scratch(config)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='row')
+        self.watcher = DirectoryWatcher(self.watch_dir, use_inotify=not poll)
+        self.jobs = Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.current_job = None
+        self.completed = deque(maxlen=10000)
+        self.counts = {'jobs_done': 0, 'tracks_done': 0, 'tracks_not_found': 0, 'searches_saved': 0}
+        self.started = time.time()
+        self.stop = threading.Event()
+        self.state_path = os.path.join(self.output_root, self.STATE_FILE)
+        self.state = {}
+        if os.path.isfile(self.state_path):
+            try:
+                with open(self.state_path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except Exception:
+                self.state = {}
+
+    def enqueue(self, path):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        self.jobs.put(path)
+        print(f"Queued {os.path.basename(path)}")
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            recent = [t for t in self.completed if now - t <= 300]
+            return {
+                'watch_dir': self.watch_dir,
+                'watch_mode': self.watcher.mode,
+                'queue_depth': self.jobs.qsize(),
+                'current_job': self.current_job,
+                'in_flight': sorted(self.in_flight.values()),
+                'throughput_tracks_per_min': round(len(recent) / (min(300, now - self.started) / 60), 2) if recent else 0.0,
+                'uptime_seconds': int(now - self.started),
+                **self.counts,
+            }
+
+    def _convert(self, engine_args, i, row, total):
+        engine = ConversionEngine(*engine_args[0], **engine_args[1])
+        title = row_fields(row, engine.playlist_name)[0]
+        key = f"{engine.playlist_name} #{i}"
+        with self.lock:
+            self.in_flight[key] = f"{key}: {title}"
+        try:
+            return engine.convert_row(i, row, total)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                self.completed.append(time.time())
+
+    def run_job(self, csv_path):
+        playlist_name = os.path.splitext(os.path.basename(csv_path))[0]
+        output_dir = os.path.join(self.output_root, playlist_name)
+        os.makedirs(output_dir, exist_ok=True)
+        # Rescan the library at most every ten minutes; it is incremental but walks every root
+        if self.library is not None and time.time() - self.library_scanned > 600:
+            self.library = open_library(self.config)
+            self.library_scanned = time.time()
+
+        rows = read_csv_rows(csv_path)
+        # One run budget and query cache for the whole CSV, shared by the per-row engines
+        query_cache = QueryCache()
+        engine_args = ((self.config, output_dir, self.ffmpeg_exe, self.yt_dlp_exe),
+                       dict(playlist_name=playlist_name, library=self.library,
+                            run_budget=RunBudget(self.config.get('budget_run', 0), len(rows)), query_cache=query_cache,
+                            scratch=self.scratch,
+                            status=lambda text: print(f"[{playlist_name}] {text}"),
+                            **{k: bool(self.options.get(k)) for k in SHARD_JOB_OPTIONS}))
+        # Bulk-resolve each window of rows while the pool is still busy with the previous one
+        bulk = ConversionEngine(*engine_args[0], **engine_args[1])
+        futures = [self.pool.submit(self._convert, engine_args, i, row, len(rows)) for i, row in bulk.windows(rows)]
+        files, not_found, degraded = [], [], []
+        for fut in futures:
+            result = fut.result()
+            if result['file']:
+                files.append(result['file'])
+            else:
+                not_found.append(result['not_found'])
+            if result.get('degraded'):
+                degraded.append(result['degraded'])
+        if not_found:
+            write_not_found_csv(output_dir, playlist_name, not_found)
+        if degraded:
+            write_budget_report(output_dir, playlist_name, degraded)
+        if self.options.get('generate_m3u', True):
+            write_m3u(output_dir, playlist_name, files)
+        with self.lock:
+            self.counts['jobs_done'] += 1
+            self.counts['tracks_done'] += len(files)
+            self.counts['tracks_not_found'] += len(not_found)
+            self.counts['searches_saved'] += query_cache.saved
+        return files, not_found
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def serve_status(self, host='127.0.0.1', port=8766):
+        service = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(service.status()).encode('utf-8')
+                self.send_response(200 if self.path in ('/', '/status') else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), StatusHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Status on http://{host}:{server.server_port}/status")
+        return server
+
+    def run(self):
+        os.makedirs(self.output_root, exist_ok=True)
+        # Pick up CSVs that arrived (or changed) while the service was down
+        for path, sig in sorted(self.watcher.existing().items()):
+            if self.state.get(path) != list(sig):
+                self.enqueue(path)
+        threading.Thread(target=self.watcher.watch, args=(self.enqueue, self.stop), daemon=True).start()
+        print(f"Watching {self.watch_dir} ({self.watcher.mode}) → {self.output_root}")
+
+        while not self.stop.is_set():
+            try:
+                path = self.jobs.get(timeout=1.0)
+            except Empty:
+                continue
+            with self.lock:
+                self.queued.discard(path)
+                self.current_job = os.path.basename(path)
+            try:
+                st = os.stat(path)
+                started = time.time()
+                files, not_found = self.run_job(path)
+                print(f"Finished {os.path.basename(path)}: {len(files)} tracks, {len(not_found)} not found "
+                      f"in {timedelta(seconds=int(time.time() - started))}")
+                self.state[path] = [st.st_mtime, st.st_size]
+                self._save_state()
+            except Exception as e:
+                print(f"Job {path} failed: {e}")
+            finally:
+                with self.lock:
+                    self.current_job = None
+        self.pool.shutdown(wait=True)
+
+
+# Synthetic smoke fixture: fictional tracks that walk every matcher path. Use match-record for a real corpus.
+MATCH_CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'matching', 'synthetic-v1.json')
+
+
+def video_id_from_spec(download_spec, recordings=None):
+    """The YouTube video ID a download spec points at. ytsearch1: specs are looked up in recordings."""
+    m = re.search(r"[?&]v=([\w-]{11})", download_spec or '')
+    if m:
+        return m.group(1)
+    if recordings and download_spec in recordings:
+        entries = (recordings[download_spec].get('json') or {}).get('entries') or []
+        if entries and isinstance(entries[0], dict):
+            return entries[0].get('id')
+    return None
+
+
+class ReplayEngine(ConversionEngine):
+    """ConversionEngine that answers yt-dlp calls from recorded output instead of the network.
+
+    recordings maps a yt-dlp search spec or URL to {'json': parsed stdout,
+    'stderr': str, 'returncode': int}. Specs with no recording behave like a
+    failed call and are listed in missing. Recorded JSON is handed to the
+    matcher as is, so timing it measures the matcher and not a stdout round trip.
+    """
+
+    def __init__(self, recordings, config, deep_search=True):
+        super().__init__(config, '', 'ffmpeg', 'yt-dlp', deep_search=deep_search, status=lambda text: None)
+        self.bulk_window = 0
+        self.recordings = recordings
+        self.calls = 0
+        self.missing = []
+
+    def fetch_json(self, extra_args, search_spec):
+        self.calls += 1
+        rec = self.recordings.get(search_spec)
+        if rec is None:
+            self.missing.append(search_spec)
+            return {}, 'no recording'
+        data = rec.get('json')
+        return (data if isinstance(data, dict) else {}), rec.get('stderr', '')
+
+    def run_yt(self, extra_args, search_spec, timeout=None):
+        raise RuntimeError(f"ReplayEngine has no recording for a live yt-dlp call: {search_spec}")
+
+
+class RecordingEngine(ConversionEngine):
+    """ConversionEngine that keeps every yt-dlp response, for building a benchmark corpus."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every search must reach run_yt on its own spec to be recorded
+        self.bulk_window = 0
+        self.recordings = {}
+
+    def run_yt(self, extra_args, search_spec, timeout=None):
+        proc = super().run_yt(extra_args, search_spec, timeout)
+        try:
+            parsed = json.loads(proc.stdout)
+        except Exception:
+            parsed = None
+        self.recordings[search_spec] = {'json': parsed, 'stderr': (proc.stderr or '')[-2000:], 'returncode': proc.returncode}
+        return proc
+
+
+def load_match_corpus(path=MATCH_CORPUS_FILE):
+    with open(path, 'r', encoding='utf-8') as f:
+        corpus = json.load(f)
+    if corpus.get('version') != 1:
+        raise ValueError(f"Unsupported corpus version: {corpus.get('version')}")
+    return corpus
+
+
+def evaluate_matcher(corpus, deep_search=True, repeat=1):
+    """Replay a labelled corpus through the matcher with no network access.
+
+    Precision counts picks that are the labelled video. Recall is measured
+    over cases that have a label; cases labelled null (track not on YouTube)
+    only count against precision when something is picked.
+
+    Round trips count every yt-dlp search or probe a track costs, including
+    the search a ytsearch1: pick leaves to the download (all of fast mode's).
+    """
+    config = {'variants': [], 'duration_min': 30, 'duration_max': 600, **corpus.get('config', {})}
+    cases = corpus['cases']
+    results = []
+    probes = 0
+    round_trips = 0
+    missing = set()
+    cpu = 0.0
+    for _ in range(max(1, repeat)):
+        results = []
+        probes = 0
+        round_trips = 0
+        for n, case in enumerate(cases, start=1):
+            engine = ReplayEngine(case['recordings'], config, deep_search)
+            with contextlib.redirect_stdout(io.StringIO()):
+                started = time.process_time()
+                _variant, _q, match = engine.match_row(n, case['row'])
+                cpu += time.process_time() - started
+            picked = video_id_from_spec(match['spec'], case['recordings'])
+            probes += engine.calls
+            round_trips += engine.calls + (1 if match['spec'].startswith('ytsearch') else 0)
+            missing.update(engine.missing)
+            results.append({'id': case['id'], 'expected': case.get('expected'), 'picked': picked})
+
+    predicted = [r for r in results if r['picked']]
+    labelled = [r for r in results if r['expected']]
+    correct = [r for r in predicted if r['picked'] == r['expected']]
+    return {
+        'cases': len(cases),
+        'synthetic': bool(corpus.get('synthetic')),
+        'mode': 'deep' if deep_search else 'fast',
+        'precision': round(len(correct) / len(predicted), 4) if predicted else 0.0,
+        'recall': round(len([r for r in labelled if r['picked'] == r['expected']]) / len(labelled), 4) if labelled else 0.0,
+        'probes_per_track': round(probes / len(cases), 3) if cases else 0.0,
+        'round_trips_per_track': round(round_trips / len(cases), 3) if cases else 0.0,
+        'cpu_ms_per_1000_tracks': round(cpu * 1000 / (len(cases) * max(1, repeat)) * 1000, 2) if cases else 0.0,
+        'wrong': [r for r in results if r['picked'] != r['expected']],
+        'missing_recordings': sorted(missing),
+    }
+
+
+def record_match_corpus(csv_path, out_path, config, ffmpeg_exe, yt_dlp_exe, deep_search=True):
+    """Run the live matcher over a labelled CSV and save its yt-dlp traffic as a corpus.
+
+    The CSV carries an extra 'Expected Video ID' column; leave it empty for
+    tracks that have no correct upload.
+    """
+    rows = read_csv_rows(csv_path)
+    cases = []
+    for n, row in enumerate(rows, start=1):
+        engine = RecordingEngine(config, '', ffmpeg_exe, yt_dlp_exe, deep_search=deep_search)
+        expected = (row.pop('Expected Video ID', '') or '').strip() or None
+        engine.match_row(n, row)
+        title = row.get('Track Name') or row.get('Track name') or ''
+        cases.append({'id': f"{n:04d}-{normalize_text(title).replace(' ', '-')[:40]}",
+                      'row': row, 'expected': expected, 'recordings': engine.recordings})
+    corpus = {
+        'version': 1,
+        'description': f"Recorded from {os.path.basename(csv_path)}",
+        'config': {k: config[k] for k in SHARD_JOB_CONFIG_KEYS if k in config},
+        'cases': cases,
+    }
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(corpus, f, indent=1, ensure_ascii=False)
+    return corpus
+
+
+
 class Tooltip:
     def __init__(self, widget, text):
         self.widget = widget
@@ -81,7 +2110,7 @@ class Spotify2MP3GUI:
     def __init__(self, root):
         self.root = root
         self.root.title('Spotify2MP3')
-        self.root.geometry('540x650')
+        self.root.geometry('540x690')
         self.root.minsize(300, 500)
         self.csv_path = None
         self.output_folder = None
@@ -241,6 +2270,10 @@ class Spotify2MP3GUI:
         self.open_folder_button.pack(pady=5)
         Tooltip(self.open_folder_button, 'Open folder with converted files.')
 
+        self.retag_button = tk.Button(self.root, text='Retag Existing Files', command=self.start_retag)
+        self.retag_button.pack(pady=5)
+        Tooltip(self.retag_button, 'Rewrite title/artist/album tags of an already converted playlist from the CSV. Nothing is downloaded.')
+
         #hide useless buttons
         self.mp3_check.pack_forget()
         self.quality_check.pack_forget()
@@ -293,16 +2326,41 @@ class Spotify2MP3GUI:
         )
         instr_cb.grid(row=5, column=1, sticky="w", padx=10)
 
+        # Existing music library
+        tk.Label(win, text="Library folders (comma-separated):").grid(row=6, column=0, sticky="w", padx=10, pady=5)
+        library_str = tk.StringVar(value=",".join(self.config.get("library_roots", [])))
+        library_entry = tk.Entry(win, textvariable=library_str, width=40)
+        library_entry.grid(row=6, column=1, padx=10, pady=5)
+        Tooltip(library_entry, 'Tracks already in these folders are linked into the playlist instead of downloaded.')
+
+        # Bandwidth
+        small_var = tk.BooleanVar(value=self.config.get("format_policy") == "smallest")
+        small_cb = tk.Checkbutton(win, text=f"Save bandwidth (smallest stream of at least {self.config.get('format_min_abr', 96)} kbps)", variable=small_var)
+        small_cb.grid(row=7, column=1, sticky="w", padx=10)
+        Tooltip(small_cb, 'Downloads the smallest audio stream that meets the bitrate floor instead of the best one.')
+
+        # Output layout
+        tk.Label(win, text="Subfolders:").grid(row=8, column=0, sticky="w", padx=10, pady=5)
+        shard_var = tk.StringVar(value=self.config.get("output_shard", "none"))
+        shard_menu = tk.OptionMenu(win, shard_var, *OutputLayout.SHARDS)
+        shard_menu.grid(row=8, column=1, sticky="w", padx=10, pady=5)
+        Tooltip(shard_menu, 'Split big playlists into subfolders of 100 tracks or by album. The M3U still lists every track.')
+
         # Buttons frame
         btn_frame = tk.Frame(win)
-        btn_frame.grid(row=6, column=0, columnspan=2, pady=10)
+        btn_frame.grid(row=9, column=0, columnspan=2, pady=10)
 
 
         def save():
             try:
                 variants = [v.strip() for v in variants_str.get().split(",") if v.strip()]
+                library_roots = [r.strip() for r in library_str.get().split(",") if r.strip()]
                 cfg = {
+                    **self.config,
                     "variants": variants,
+                    "library_roots": library_roots,
+                    "format_policy": "smallest" if small_var.get() else "best",
+                    "output_shard": shard_var.get(),
                     "duration_min": int(min_var.get()),
                     "duration_max": int(max_var.get()),
                     "transcode_mp3": self.mp3_var.get(),
@@ -379,6 +2437,28 @@ class Spotify2MP3GUI:
         self.root.config(cursor='watch')
         threading.Thread(target=self.convert_playlist, daemon=True).start()
 
+    def start_retag(self):
+        if not (self.csv_path and self.output_folder):
+            messagebox.showerror('Error', 'Select CSV and output folder.')
+            return
+        playlist_name = os.path.splitext(os.path.basename(self.csv_path))[0]
+        folder = os.path.join(self.output_folder, playlist_name)
+        if not os.path.isdir(folder):
+            messagebox.showerror('Error', f'No converted playlist folder found:\n{folder}')
+            return
+        self.retag_button.config(state=tk.DISABLED)
+        self.status_label.config(text='Retagging existing files...')
+
+        def work():
+            try:
+                stats = retag_folder(self.csv_path, folder)
+                self.status_label.config(text=f"✅ Retagged {stats['changed']} of {stats['files']} files ({stats['unchanged']} already correct)")
+            except Exception as e:
+                messagebox.showerror('Error', f'Retag failed: {e}')
+            finally:
+                self.retag_button.config(state=tk.NORMAL)
+        threading.Thread(target=work, daemon=True).start()
+
     def handle_drop(self, event):
         path = event.data.strip('{}')
         if path.lower().endswith('.csv'):
@@ -455,203 +2535,62 @@ class Spotify2MP3GUI:
         match = re.match(r'^(\d+)_', filename)
         return int(match.group(1)) if match else float('inf')
 
-    def rename_album_art(self, output_dir, not_found_songs=None):
-        if not_found_songs is None:
-            not_found_songs = []
-            
-        # Create a set of failed song track numbers for faster lookup
-        failed_track_numbers = {song['Track Number'] for song in not_found_songs}
-        
-        # Get all audio files (MP3 and M4A) and JPG files
-        audio_files = [f for f in os.listdir(output_dir) if f.lower().endswith(('.mp3', '.m4a'))]
-        jpg_files = [f for f in os.listdir(output_dir) if f.endswith('.jpg')]
-        
-        # Sort audio files by creation time (date added)
-        audio_files.sort(key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
-        
-        # Sort JPG files by their number prefix
-        jpg_files.sort(key=self.get_jpg_number)
-        
-        # Make sure we have the same number of files
-        if len(audio_files) != len(jpg_files):
-            print(f"Warning: Number of files doesn't match! Audio files: {len(audio_files)}, JPG: {len(jpg_files)}")
-            print("Will process as many files as possible.")
-        
-        # Process files in pairs
-        i = 0
-        while i < len(audio_files) and i < len(jpg_files):
-            audio_file = audio_files[i]
-            jpg_file = jpg_files[i]
-            
-            # Get the track number from the JPG filename
-            jpg_number = self.get_jpg_number(jpg_file)
-            
-            # Skip if this track number was in the failed songs list
-            if jpg_number in failed_track_numbers:
-                # Remove only the JPG file from the list
-                jpg_files.pop(i)
+    def cover_jpgs(self, output_dir):
+        """{row number: cover JPG filename} for the covers fetch_spotify_album_art saved."""
+        jpg_by_number = {}
+        for f in os.listdir(output_dir):
+            if f.endswith('.jpg'):
+                jpg_by_number.setdefault(self.get_jpg_number(f), f)
+        return jpg_by_number
+
+    def rename_album_art(self, output_dir, tracks):
+        """Move each numbered cover JPG next to its track as <track name>.jpg.
+
+        tracks is the in-memory index of the run: [(row number, row, file
+        relative to output_dir)] for files that were produced. The cover
+        fetcher names JPGs by row number ("42_..."), so they pair by number
+        and failed rows simply have no audio file. Returns {file: jpg}.
+        """
+        jpg_by_number = self.cover_jpgs(output_dir)
+        art = {}
+        for i, _row, rel in tracks:
+            jpg_file = jpg_by_number.get(i)
+            if not jpg_file:
                 continue
-                
-            # Generate new jpg filename based on audio filename
-            new_jpg_name = self.clean_filename_for_artwork(audio_file) + '.jpg'
-            print(f"New JPG name: {new_jpg_name}")
-            
+            new_jpg = self.clean_filename_for_artwork(rel) + '.jpg'
             try:
-                os.rename(
-                    os.path.join(output_dir, jpg_file),
-                    os.path.join(output_dir, new_jpg_name)
-                )
-                print(f"Successfully renamed {jpg_file} to {new_jpg_name}")
+                os.rename(os.path.join(output_dir, jpg_file), os.path.join(output_dir, new_jpg))
+                print(f"Successfully renamed {jpg_file} to {new_jpg}")
+                art[rel] = new_jpg
             except Exception as e:
                 print(f"Error renaming file: {e}")
-            
-            i += 1
+        return art
 
-    def embed_all_artwork(self, output_dir, not_found_songs=None):
-        """Embed artwork for all audio files, skipping songs that weren't found"""
-        if not_found_songs is None:
-            not_found_songs = []
-            
+    def embed_all_artwork(self, output_dir, tracks, art):
+        """Re-tag and embed the renamed cover art into every track that has one"""
         print("\n=== Starting metadata and artwork embedding process ===")
-        print(f"Number of not found songs: {len(not_found_songs)}")
-        if not_found_songs:
-            print("Not found songs:")
-            for song in not_found_songs:
-                print(f"  Track {song['Track Number']}: {song['Track Name']} by {song['Artist Name(s)']}")
-            
-        # Create a set of failed song track numbers for faster lookup
-        failed_track_numbers = {song['Track Number'] for song in not_found_songs}
-        print(f"Failed track numbers: {failed_track_numbers}")
-        
-        # Read CSV file once and store in memory
-        csv_data = []
-        try:
-            with open(self.csv_path, 'r', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                # Filter out failed tracks from CSV data
-                csv_data = [row for i, row in enumerate(reader, 1) if i not in failed_track_numbers]
-                print(f"\nLoaded {len(csv_data)} entries from CSV file (excluding failed tracks)")
-                print("First few CSV entries:")
-                for i, row in enumerate(csv_data[:3]):
-                    print(f"Entry {i+1}:")
-                    print(f"  Title: {row.get('Track Name') or row.get('Track name')}")
-                    print(f"  Artist: {row.get('Artist Name(s)') or row.get('Artist name')}")
-                    print(f"  Album: {row.get('Album Name') or row.get('Album')}")
-        except Exception as e:
-            print(f"Error reading CSV file: {str(e)}")
-            return
-        
-        # Get all audio files (both M4A and MP3) and JPG files
-        audio_files = [f for f in os.listdir(output_dir) if f.lower().endswith(('.m4a', '.mp3'))]
-        jpg_files = [f for f in os.listdir(output_dir) if f.endswith('.jpg')]
-        
-        print(f"\nFound {len(audio_files)} audio files and {len(jpg_files)} JPG files")
-        
-        # Sort audio files by creation time (date added)
-        audio_files.sort(key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
-        
-        print("\nAudio files sorted by creation time:")
-        for i, f in enumerate(audio_files):
-            print(f"{i+1}. {f}")
-            
-        print("\nJPG files:")
-        for i, f in enumerate(jpg_files):
-            print(f"{i+1}. {f}")
-        
-        # Process files in pairs
-        csv_index = 0  # Separate index for CSV data
-        for audio_file in audio_files:
-            print(f"\nProcessing audio file: {audio_file}")
-            
-            # Find matching JPG file by base name
-            audio_base = os.path.splitext(audio_file)[0]
-            matching_jpg = None
-            for jpg_file in jpg_files:
-                jpg_base = os.path.splitext(jpg_file)[0]
-                if jpg_base == audio_base:
-                    matching_jpg = jpg_file
-                    break
-            
-            if matching_jpg:
-                print(f"Found matching JPG: {matching_jpg}")
-                try:
-                    audio_path = os.path.join(output_dir, audio_file)
-                    jpg_path = os.path.join(output_dir, matching_jpg)
-                    
-                    # Get metadata from CSV in the same order
-                    if csv_index < len(csv_data):
-                        row = csv_data[csv_index]
-                        title = row.get('Track Name') or row.get('Track name') or 'Unknown'
-                        artist = row.get('Artist Name(s)') or row.get('Artist name') or 'Unknown'
-                        album = row.get('Album Name') or row.get('Album') or 'Unknown'
-                        print(f"\nUsing metadata from CSV (row {csv_index+1}):")
-                        print(f"  Title: {title}")
-                        print(f"  Artist: {artist}")
-                        print(f"  Album: {album}")
-                        csv_index += 1
-                    else:
-                        print(f"No matching artwork found for {audio_file} (expected {jpg_file})")
-                        title = os.path.splitext(audio_file)[0]
-                        artist = 'Unknown Artist'
-                        album = 'Unknown Album'
-                        print(f"\nNo matching CSV row found, using defaults:")
-                        print(f"  Title: {title}")
-                        print(f"  Artist: {artist}")
-                        print(f"  Album: {album}")
-                    
-                    if audio_file.lower().endswith('.m4a'):
-                        print("\nEmbedding metadata for M4A file...")
-                        audio = MP4(audio_path)
-                        tags = audio.tags or MP4Tags()
-                        tags['\xa9nam'] = [title]  # Title
-                        tags['\xa9ART'] = [artist]  # Artist
-                        tags['\xa9alb'] = [album]  # Album
-                        audio.save()
-                        print("M4A metadata embedded successfully")
-                    else:  # MP3
-                        print("\nEmbedding metadata for MP3 file...")
-                        try:
-                            audio = EasyID3(audio_path)
-                        except:
-                            audio = EasyID3()
-                        audio['title'] = title
-                        audio['artist'] = artist 
-                        audio['album'] = album
-                        audio.save()
-                        print("MP3 metadata embedded successfully")
-                    
-                    # Embed artwork
-                    print(f"\nEmbedding artwork from: {matching_jpg}")
-                    self.embed_artwork(audio_path, jpg_path)
-                    
-                except Exception as e:
-                    print(f"Error processing {audio_file}: {str(e)}")
-            else:
-                print(f"No matching JPG file found for {audio_file}")
-            
-            print(f"=== Finished processing {audio_file} ===\n")
+        playlist_name = os.path.basename(output_dir)
+        for i, row, rel in tracks:
+            jpg = art.get(rel)
+            if not jpg:
+                print(f"No matching JPG file found for {rel}")
+                continue
+            audio_path = os.path.join(output_dir, rel)
+            # A hardlink is the user's library file; tagging it would rewrite the original
+            if os.stat(audio_path).st_nlink > 1:
+                print(f"Skipping artwork for library link {rel}")
+                continue
+            try:
+                title, artist, album, _ = row_fields(row, playlist_name)
+                print(f"\nTrack {i}: {title} / {artist} / {album}")
+                tag_audio_file(audio_path, title, artist, album)
+                self.embed_artwork(audio_path, os.path.join(output_dir, jpg))
+            except Exception as e:
+                print(f"Error processing {rel}: {str(e)}")
     
 
     def convert_playlist(self):
-        
-        def normalize(text: str) -> str:
-            """Lowercase and strip out any punctuation, leaving only word chars and spaces."""
-            return re.sub(r"[^\w\s]", "", text.lower())
-
-        def contains_keywords_in_order(candidate_title: str, keywords: list[str]) -> bool:
-            txt = normalize(candidate_title)
-            pos = 0
-            for kw in keywords:
-                idx = txt.find(kw, pos)
-                if idx < 0:
-                    return False
-                pos = idx + len(kw)
-            return True
-
         start_time = time.time()
-        # Load duration filters from settings
-        duration_min = self.config.get("duration_min", 0)
-        duration_max = self.config.get("duration_max", float("inf"))
         self.status_label.config(text='Starting conversion...')
         playlist_name = os.path.splitext(os.path.basename(self.csv_path))[0]
         output_dir = os.path.join(self.output_folder, playlist_name)
@@ -673,185 +2612,62 @@ class Spotify2MP3GUI:
             'status_text': self.status_label.cget('text')
         }
 
+        def status(text):
+            self.status_label.config(text=text)
+            self.root.update_idletasks()
+
         try:
             if self.spotify_art_var.get():
                 self.fetch_spotify_album_art(output_dir)
 
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            if platform.system() == "Darwin":
-                ffmpeg_exe = os.path.join(resource_path("ffmpeg"), "ffmpeg")
-                yt_dlp_exe = os.path.join(resource_path("yt-dlp"), "yt-dlp")
-            elif platform.system() == "Linux":
-                ffmpeg_exe = shutil.which("ffmpeg") or "ffmpeg"
-                yt_dlp_exe = shutil.which("yt-dlp") or "yt-dlp"
-            else:
-                ffmpeg_exe = os.path.join(base_dir, "ffmpeg", "ffmpeg.exe")
-                yt_dlp_exe = os.path.join(base_dir, "yt-dlp", "yt-dlp.exe")
-
-            if not os.path.isfile(ffmpeg_exe) or not os.path.isfile(yt_dlp_exe):
-                missing = []
-                if not os.path.isfile(ffmpeg_exe): missing.append('ffmpeg')
-                if not os.path.isfile(yt_dlp_exe): missing.append('yt-dlp')
+            ffmpeg_exe, yt_dlp_exe = find_tools(self.config)
+            missing = missing_tools(ffmpeg_exe, yt_dlp_exe)
+            if missing:
                 messagebox.showerror('Missing Executable', f"{', '.join(missing)} not found. Please install.")
                 return
 
-            rows = list(csv.DictReader(open(self.csv_path, newline='', encoding='utf-8')))
+            # With a scratch folder, covers are embedded there before each file is published
+            embedded = set()
+            stage_covers = self.spotify_art_var.get() and self.config.get('scratch_dir')
+            covers = self.cover_jpgs(output_dir) if stage_covers else {}
+
+            def stage_artwork(i, path):
+                # A failure leaves the track to the after-run pass instead of aborting the run
+                if i in covers:
+                    try:
+                        self.embed_artwork(path, os.path.join(output_dir, covers[i]))
+                        embedded.add(i)
+                    except Exception as e:
+                        print(f"Error processing {os.path.basename(path)}: {str(e)}")
+
+            engine = ConversionEngine(
+                self.config, output_dir, ffmpeg_exe, yt_dlp_exe, playlist_name=playlist_name,
+                deep_search=self.deep_search_var.get(),
+                transcode_mp3=self.mp3_var.get(),
+                embed_thumbnails=self.thumb_var.get(),
+                exclude_instrumentals=self.exclude_instr_var.get(),
+                library=open_library(self.config, status),
+                status=status,
+                post_process=stage_artwork if stage_covers else None,
+            )
+
+            rows = read_csv_rows(self.csv_path)
             total = len(rows)
             self.progress['maximum'] = total
-            archive_file = os.path.join(output_dir, 'downloaded.txt')
-            creationflags = subprocess.CREATE_NO_WINDOW if platform.system() == 'Windows' else 0
-
-            for i, row in enumerate(rows, start=1):
-                title = row.get('Track Name') or row.get('Track name') or 'Unknown'
-                artist_raw = row.get('Artist Name(s)') or row.get('Artist name') or 'Unknown'
-                artist_primary = re.split(r'[,/&]| feat\.| ft\.', artist_raw, flags=re.I)[0].strip()
-                safe_artist = re.sub(r"[^\w\s]", '', artist_primary)
-                album = row.get('Album Name') or row.get('Album') or playlist_name
-                spotify_ms = row.get('Duration (ms)')
-                spotify_sec = int(spotify_ms) / 1000 if spotify_ms and spotify_ms.isdigit() else None
-
-                safe_title = re.sub(r"[^\w\s]", '', title)
-                variants = self.config.get('variants') or ['']
-                if 'instrumental' in title.lower():
-                    variants.insert(0, 'instrumental')
-
-                best_file = None
-                for variant in variants:
-                    parts = [safe_title]
-                    if safe_artist and safe_artist.lower() != 'unknown': parts.append(safe_artist)
-                    if variant: parts.append(variant)
-                    q = ' '.join(parts)
-                    print(f"Searching for → {q!r}")
-                    self.status_label.config(text=f"[{i}/{total}] Searching: {q}")
-                    self.root.update_idletasks()
-
-                    def yt_cmd(extra_args, search_spec):
-                        cmd = [yt_dlp_exe, f"--ffmpeg-location={os.path.dirname(ffmpeg_exe)}", "--no-config"]
-                        if cookies_path: cmd += ["--cookies", cookies_path]
-                        cmd += extra_args + [search_spec]
-                        return cmd
-
-                    if self.deep_search_var.get():
-                        # Phase 1: quick flat-playlist probe
-                        proc_q = subprocess.run(
-                            yt_cmd(["--flat-playlist", "--dump-single-json", "--no-playlist"], f"ytsearch1:{q}"),
-                            capture_output=True, text=True, creationflags=creationflags
-                        )
-                        try:
-                            data_q = json.loads(proc_q.stdout) or {}
-                        except Exception:
-                            data_q = {}
-                        if not isinstance(data_q, dict): data_q = {}
-                        entries_q = data_q.get('entries') if isinstance(data_q.get('entries'), list) else []
-                        top = entries_q[0] if entries_q else {}
-
-                        vid_title = top.get('title', '')
-                        upl = (top.get('uploader') or '').lower()
-                        duration = top.get('duration') or 0
-                        passes = (
-                            safe_title.lower() in vid_title.lower()
-                            and (not safe_artist or safe_artist.lower() in upl)
-                            and (not spotify_sec or abs(duration - spotify_sec) <= 10)
-                            and (duration >= duration_min and duration <= duration_max)
-                        )
-                        if passes:
-                            download_spec = top.get('webpage_url', f"https://www.youtube.com/watch?v={top.get('id','')}" )
-                        else:
-                            print("Deep searching : " + title)
-                            # Phase 2: deep-search candidate IDs
-                            proc_ids = subprocess.run(
-                                yt_cmd(["--flat-playlist", "--dump-single-json", "--no-playlist"], f"ytsearch3:{q}"),
-                                capture_output=True, text=True, creationflags=creationflags
-                            )
-                            try:
-                                tmp = json.loads(proc_ids.stdout) or {}
-                            except Exception:
-                                tmp = {}
-                            data_ids = tmp if isinstance(tmp, dict) else {}
-                            entries_ids = data_ids.get('entries') if isinstance(data_ids.get('entries'), list) else []
-                            ids = [e for e in entries_ids if isinstance(e, dict)][:3]
-
-                            scored = []
-                            first_words = normalize(title).split()[:5]
-                            for entry in ids:
-                                vid = entry.get('id')
-                                url = f"https://www.youtube.com/watch?v={vid}"
-                                proc_i = subprocess.run(
-                                    yt_cmd(["--dump-single-json", "--no-playlist"], url),
-                                    capture_output=True, text=True, creationflags=creationflags
-                                )
-                                if "Sign in to confirm your age" in (proc_i.stderr or ''):
-                                    continue
-                                try:
-                                    info = json.loads(proc_i.stdout) or {}
-                                except Exception:
-                                    continue
-
-                                raw_title = info.get('title','')
-                                low = raw_title.lower()
-                                up2 = (info.get('uploader') or '').lower()
-                                dur2 = info.get('duration') or 0
-                                # enforce duration bounds
-                                if dur2 < duration_min or dur2 > duration_max:
-                                    continue
-                                if 'shorts/' in info.get('webpage_url','') or '#shorts' in low: continue
-                                if safe_artist.lower() and safe_artist.lower() not in up2: continue
-                                if variant and variant.lower() not in low: continue
-                                if not contains_keywords_in_order(raw_title, first_words): continue
-                                score = 100 if low.startswith(safe_title.lower()) else 80
-                                if spotify_sec: score -= abs(dur2 - spotify_sec)
-                                scored.append((score, url))
-                            download_spec = scored and max(scored, key=lambda x: x[0])[1] or f"ytsearch1:{q}"
-                    else:
-                        download_spec = f"ytsearch1:{q}"
-
-                    # Download
-                    file_title = re.sub(r"[^\w\s]", "", title).strip()
-                    base = f"{i:03d} - {file_title}" + (f" - {variant}" if variant else "")
-                    tmpl = base + ".%(ext)s"
-                    cmd_dl = yt_cmd([
-                        '--download-archive', archive_file,
-                        '-f', 'bestaudio[ext=m4a]/bestaudio',
-                        '--output', os.path.join(output_dir, tmpl),
-                        '--no-playlist'
-                    ], download_spec)
-                    if self.thumb_var.get(): cmd_dl += ['--embed-thumbnail','--add-metadata']
-                    if self.mp3_var.get(): cmd_dl += ['--extract-audio','--audio-format','mp3','--audio-quality','0']
-                    else: cmd_dl += ['--remux-video','m4a']
-                    if self.exclude_instr_var.get(): cmd_dl += ['--reject-title','instrumental']
-
-                    ret = subprocess.run(cmd_dl, capture_output=True, text=True, creationflags=creationflags)
-                    if ret.returncode != 0:
-                        stderr = ret.stderr or ''
-                        if 'Sign in to confirm your age' in stderr:
-                            not_found_songs.append({
-                                'Track Name': title,
-                                'Artist Name(s)': artist_primary,
-                                'Album Name': album,
-                                'Track Number': i,
-                                'Error': 'Age-restricted video'
-                            })
-                            break
-                        else:
-                            print(f"Download failed for {download_spec}: {stderr[:200]}")
-                            continue
-                    out_ext = '.mp3' if self.mp3_var.get() else '.m4a'
-                    candidate_path = os.path.join(output_dir, base + out_ext)
-                    if os.path.isfile(candidate_path):
-                        best_file = candidate_path
-                        if out_ext == '.m4a':
-                            audio = MP4(best_file); tags = audio.tags or MP4Tags()
-                            tags['\xa9nam']=[title]; tags['\xa9ART']=[artist_primary]; tags['\xa9alb']=[album]; audio.save()
-                        else:
-                            audio = EasyID3();
-                            try: audio.load(best_file)
-                            except: pass
-                            audio.update({'artist':artist_primary,'title':title,'album':album,'tracknumber':str(i)}); audio.save()
-                        downloaded.append(os.path.basename(best_file))
-                        break
-
-                if not best_file:
-                    not_found_songs.append({'Track Name':title,'Artist Name(s)':artist_primary,'Album Name':album,'Track Number':i,'Error':'No valid download'})
+            engine.start_run(total)
+            degraded = []
+
+            # In-memory index of produced files, so the post-stages never list the folder
+            tracks = []
+            for i, row in engine.windows(rows):
+                result = engine.convert_row(i, row, total)
+                if result['file']:
+                    downloaded.append(result['file'])
+                    tracks.append((i, row, result['file']))
+                else:
+                    not_found_songs.append(result['not_found'])
+                if result.get('degraded'):
+                    degraded.append(result['degraded'])
 
                 elapsed = time.time() - start_time
                 eta = timedelta(seconds=int((elapsed/i)*(total-i)))
@@ -859,25 +2675,20 @@ class Spotify2MP3GUI:
                 self.status_label.config(text=f"Downloaded {i}/{total}, ETA: {eta}")
                 self.root.update_idletasks()
 
+            if engine.bytes_saved:
+                print(f"Format policy saved {engine.bytes_saved / 1048576:.1f} MiB of downloads")
+            if engine.query_cache.saved:
+                print(f"Query planner saved {engine.query_cache.saved} searches")
             if not_found_songs:
-                nf_path = os.path.join(output_dir, f"{playlist_name}_not_found.csv")
-                with open(nf_path, 'w', newline='', encoding='utf-8') as cf:
-                    writer = csv.DictWriter(cf, fieldnames=['Track Name','Artist Name(s)','Album Name','Track Number','Error'])
-                    writer.writeheader()
-                    writer.writerows(not_found_songs)
+                write_not_found_csv(output_dir, playlist_name, not_found_songs)
+            if degraded:
+                write_budget_report(output_dir, playlist_name, degraded)
             if self.m3u_var.get():
-                m3u_filename = playlist_name.replace('_',' ')
-                m3u_path = os.path.join(output_dir, f"{m3u_filename}.m3u")
-                with open(m3u_path,'w',encoding='utf-8') as m3u:
-                    m3u.write('#EXTM3U\n')
-                    audio_files = sorted([f for f in os.listdir(output_dir) if f.lower().endswith(('.mp3','.m4a'))], key=lambda x: os.path.getctime(os.path.join(output_dir,x)))
-                    for fn in audio_files:
-                        m3u.write(f'#EXTINF:-1,{os.path.splitext(fn)[0]}\n')
-                        m3u.write(f'{fn}\n')
+                write_m3u(output_dir, playlist_name, downloaded)
 
             if self.spotify_art_var.get():
-                self.rename_album_art(output_dir)
-                self.embed_all_artwork(output_dir)
+                art = self.rename_album_art(output_dir, tracks)
+                self.embed_all_artwork(output_dir, [t for t in tracks if t[0] not in embedded], art)
 
             self.progress['value'] = self.progress['maximum']
             self.root.config(cursor='')
@@ -894,8 +2705,6 @@ class Spotify2MP3GUI:
             self.clear_button.config(state=tk.NORMAL)
             self.root.update_idletasks()
 
-
-
     def restore_state(self, state):
         """Restore the UI to its initial state"""
         try:
@@ -923,7 +2732,202 @@ class Spotify2MP3GUI:
             self.spotify_art_check.config(state=tk.NORMAL)
 
 
+def build_cli_parser():
+    parser = argparse.ArgumentParser(prog='spotify2media', description='Headless Spotify2MP3 modes. Run without arguments for the GUI.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('shard-init', help='Split a CSV (or a match plan) into a shared SQLite work queue')
+    p.add_argument('--queue', required=True, help='SQLite file to create')
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument('--csv')
+    src.add_argument('--plan', help='Plan file from the plan command; workers then download without searching')
+    p.add_argument('--output', required=True, help='Output folder; the playlist folder is created inside it')
+    p.add_argument('--fast', action='store_true', help='Disable Deep Search')
+    p.add_argument('--mp3', action='store_true', help='Transcode to MP3')
+    p.add_argument('--thumbnails', action='store_true', help='Embed video thumbnails')
+    p.add_argument('--exclude-instrumentals', action='store_true')
+
+    p = sub.add_parser('shard-serve', help='Serve a SQLite work queue to workers over HTTP')
+    p.add_argument('--queue', required=True)
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--lease', type=int, default=300, help='Lease length in seconds')
+
+    p = sub.add_parser('shard-worker', help='Claim and convert rows from a queue')
+    p.add_argument('--queue', required=True, help='SQLite file or http:// coordinator URL')
+    p.add_argument('--id', help='Worker name (default: host-pid)')
+    p.add_argument('--output', help='Override the job output folder (e.g. a local mount of the shared folder)')
+    p.add_argument('--batch', type=int, default=1, help='Rows to lease at a time (their searches run in one yt-dlp call)')
+    p.add_argument('--lease', type=int, default=300, help='Lease length in seconds (SQLite queues; remote workers use the coordinator\'s)')
+
+    p = sub.add_parser('shard-status', help='Show queue progress')
+    p.add_argument('--queue', required=True)
+
+    p = sub.add_parser('shard-finalize', help='Write the M3U and not-found CSV for a finished queue')
+    p.add_argument('--queue', required=True)
+    p.add_argument('--output', help='Override the job output folder')
+    p.add_argument('--no-m3u', action='store_true')
+
+    p = sub.add_parser('plan', help='Match every row of a CSV and write a plan file, without downloading')
+    p.add_argument('--csv', required=True)
+    p.add_argument('--out', help='Plan file (default: <playlist>.plan.json next to the CSV)')
+    p.add_argument('--fast', action='store_true', help='Disable Deep Search')
+
+    p = sub.add_parser('execute', help='Download a (possibly edited) plan file with no search calls')
+    p.add_argument('--plan', required=True)
+    p.add_argument('--output', required=True, help='Output folder; the playlist folder is created inside it')
+    p.add_argument('--mp3', action='store_true', help='Transcode to MP3')
+    p.add_argument('--thumbnails', action='store_true', help='Embed video thumbnails')
+    p.add_argument('--exclude-instrumentals', action='store_true')
+    p.add_argument('--no-m3u', action='store_true')
+
+    p = sub.add_parser('watch', help='Convert every CSV dropped into a folder, as a long-running service')
+    p.add_argument('--dir', required=True, help='Folder to watch for CSV files')
+    p.add_argument('--output', required=True, help='Output folder; each playlist gets a folder inside it')
+    p.add_argument('--fast', action='store_true', help='Disable Deep Search')
+    p.add_argument('--mp3', action='store_true', help='Transcode to MP3')
+    p.add_argument('--thumbnails', action='store_true', help='Embed video thumbnails')
+    p.add_argument('--exclude-instrumentals', action='store_true')
+    p.add_argument('--no-m3u', action='store_true')
+    p.add_argument('--workers', type=int, default=4, help='Rows converted in parallel')
+    p.add_argument('--poll', action='store_true', help='Poll the folder instead of using inotify')
+    p.add_argument('--status-host', default='127.0.0.1')
+    p.add_argument('--status-port', type=int, default=8766, help='JSON status endpoint port (0 to disable)')
+
+    p = sub.add_parser('retag', help="Fix tags of an existing output folder from its CSV (no downloads, no ffmpeg)")
+    p.add_argument('--csv', required=True)
+    p.add_argument('--folder', required=True, help='Playlist folder holding the NNN - Title files')
+    p.add_argument('--workers', type=int, help='Worker processes (default: CPU count)')
+    p.add_argument('--dry-run', action='store_true', help='Only report what would change')
+    p.add_argument('--include-links', action='store_true', help='Also retag files hardlinked from the library')
+
+    p = sub.add_parser('match-bench', help='Replay the labelled matching corpus offline and report accuracy/cost')
+    p.add_argument('--corpus', default=MATCH_CORPUS_FILE)
+    p.add_argument('--fast', action='store_true', help='Evaluate fast (non-Deep Search) mode')
+    p.add_argument('--repeat', type=int, default=5, help='Replays used for the CPU time figure')
+    p.add_argument('--json', action='store_true', help='Print the full report as JSON')
+
+    p = sub.add_parser('match-record', help='Record live yt-dlp responses for a labelled CSV into a corpus file')
+    p.add_argument('--csv', required=True, help="CSV with an extra 'Expected Video ID' column")
+    p.add_argument('--out', required=True)
+    p.add_argument('--fast', action='store_true')
+    return parser
+
+
+def run_cli(argv):
+    args = build_cli_parser().parse_args(argv)
+    if args.command == 'shard-init':
+        cfg = load_config()
+        options = {
+            'deep_search': not args.fast,
+            'transcode_mp3': args.mp3,
+            'embed_thumbnails': args.thumbnails,
+            'exclude_instrumentals': args.exclude_instrumentals,
+            'config': {k: cfg[k] for k in SHARD_JOB_CONFIG_KEYS if k in cfg},
+        }
+        plan = load_plan(args.plan) if args.plan else None
+        queue = ShardQueue.create(args.queue, args.csv, args.output, options, plan=plan)
+        job = queue.job()
+        print(f"Queued {job['total']} rows into {args.queue} → {job['output_dir']}")
+    elif args.command == 'shard-serve':
+        server = serve_shard_queue(ShardQueue(args.queue, lease_seconds=args.lease), args.host, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'shard-worker':
+        queue = open_shard_queue(args.queue, lease_seconds=args.lease)
+        # Renew well before the lease runs out
+        n = run_shard_worker(queue, args.id, args.output, args.batch)
+        print(f"Worker done after {n} rows")
+    elif args.command == 'shard-status':
+        print(json.dumps(open_shard_queue(args.queue).status()))
+    elif args.command == 'shard-finalize':
+        queue = open_shard_queue(args.queue)
+        counts = queue.status()
+        if counts['pending'] or counts['leased']:
+            print(f"Job not finished yet: {counts}")
+            return 1
+        files, not_found = finalize_shard_job(queue, args.output, not args.no_m3u)
+        print(f"{len(files)} tracks, {len(not_found)} not found")
+    elif args.command in ('plan', 'execute'):
+        cfg = load_config()
+        ffmpeg_exe, yt_dlp_exe = find_tools(cfg)
+        missing = missing_tools(ffmpeg_exe, yt_dlp_exe)
+        if missing:
+            print(f"{', '.join(missing)} not found. Please install.")
+            return 1
+        if args.command == 'plan':
+            playlist_name = os.path.splitext(os.path.basename(args.csv))[0]
+            out = args.out or os.path.splitext(args.csv)[0] + '.plan.json'
+            engine = ConversionEngine(cfg, '', ffmpeg_exe, yt_dlp_exe, playlist_name=playlist_name, deep_search=not args.fast)
+            entries = build_plan(engine, args.csv, out)
+            print(f"Planned {len(entries)} rows ({sum(1 for e in entries if e.get('video_id'))} matched, "
+                  f"{engine.query_cache.saved} searches saved) → {out}")
+        else:
+            plan = load_plan(args.plan)
+            output_dir = os.path.join(args.output, plan['playlist_name'])
+            os.makedirs(output_dir, exist_ok=True)
+            engine = ConversionEngine(
+                cfg, output_dir, ffmpeg_exe, yt_dlp_exe, playlist_name=plan['playlist_name'],
+                transcode_mp3=args.mp3, embed_thumbnails=args.thumbnails,
+                exclude_instrumentals=args.exclude_instrumentals, library=open_library(cfg),
+            )
+            files, not_found = execute_plan(engine, plan, not args.no_m3u)
+            print(f"{len(files)} tracks, {len(not_found)} not found → {output_dir}")
+    elif args.command == 'watch':
+        options = {
+            'deep_search': not args.fast,
+            'transcode_mp3': args.mp3,
+            'embed_thumbnails': args.thumbnails,
+            'exclude_instrumentals': args.exclude_instrumentals,
+            'generate_m3u': not args.no_m3u,
+        }
+        service = WatchService(args.dir, args.output, load_config(), options, args.workers, args.poll)
+        if args.status_port:
+            service.serve_status(args.status_host, args.status_port)
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            service.stop.set()
+    elif args.command == 'retag':
+        started = time.time()
+        stats = retag_folder(args.csv, args.folder, args.workers, args.dry_run, args.include_links)
+        for name, detail in sorted(stats.pop('changes').items()):
+            print(f"  {name}: {detail}")
+        print(f"{'Would retag' if args.dry_run else 'Retagged'} {stats['changed']} of {stats['files']} files "
+              f"({stats['unchanged']} unchanged, {stats['linked']} library links skipped, {stats['no_row']} without a CSV row, "
+              f"{stats['error']} errors) in {time.time() - started:.1f}s")
+    elif args.command == 'match-bench':
+        report = evaluate_matcher(load_match_corpus(args.corpus), deep_search=not args.fast, repeat=args.repeat)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            if report.get('synthetic'):
+                print("Synthetic fixture: checks that each matcher path still behaves, not real-world accuracy")
+            print(f"{report['cases']} cases ({report['mode']}): precision {report['precision']:.3f}, recall {report['recall']:.3f}, "
+                  f"{report['round_trips_per_track']} yt-dlp round trips/track ({report['probes_per_track']} from the matcher), "
+                  f"{report['cpu_ms_per_1000_tracks']} ms CPU per 1,000 tracks")
+            for r in report['wrong']:
+                print(f"  {r['id']}: expected {r['expected']}, picked {r['picked']}")
+            if report['missing_recordings']:
+                print(f"  {len(report['missing_recordings'])} yt-dlp calls had no recording (corpus needs re-recording)")
+    elif args.command == 'match-record':
+        cfg = load_config()
+        ffmpeg_exe, yt_dlp_exe = find_tools(cfg)
+        corpus = record_match_corpus(args.csv, args.out, cfg, ffmpeg_exe, yt_dlp_exe, deep_search=not args.fast)
+        print(f"Recorded {len(corpus['cases'])} cases into {args.out}")
+    return 0
+
+
+CLI_COMMANDS = ('shard-init', 'shard-serve', 'shard-worker', 'shard-status', 'shard-finalize', 'plan', 'execute',
+                'watch', 'retag', 'match-bench', 'match-record')
+
+
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS + ('-h', '--help'):
+        sys.exit(run_cli(sys.argv[1:]))
     if _tkdnd_imported:
         try:
             root = TkinterDnD.Tk()
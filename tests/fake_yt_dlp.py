@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Stand-in for yt-dlp, for running the converter offline.
+
+Point config.json's yt_dlp_path (and ffmpeg_path, which is never run) at
+this file. Searches answer with one made-up video per query whose title,
+uploader and duration fit the query, so fast mode and phase 1 accept it.
+Downloads write a short silent MP3 to the --output template and honour
+--download-archive. FAKE_YTDLP_DELAY adds seconds of latency to every call.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+
+# One silent MPEG-1 layer III frame; 50 of them make a file mutagen can read and tag
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def video_id(query):
+    return hashlib.md5(query.encode('utf-8')).hexdigest()[:11]
+
+
+def entry(query, duration):
+    vid = video_id(query)
+    words = query.split()
+    return {'id': vid, 'title': query, 'uploader': words[-1] if words else '', 'duration': duration,
+            'webpage_url': f'https://www.youtube.com/watch?v={vid}'}
+
+
+def main(args):
+    time.sleep(float(os.environ.get('FAKE_YTDLP_DELAY', '0')))
+    duration = int(os.environ.get('FAKE_YTDLP_DURATION', '200'))
+    specs = [a for a in args if a.startswith(('ytsearch', 'http'))]
+
+    if '--dump-single-json' in args:
+        for spec in specs:
+            if spec.startswith('ytsearch'):
+                n, query = spec[len('ytsearch'):].split(':', 1)
+                entries = [entry(query if k == 0 else f'{query} alt{k}', duration) for k in range(int(n or 1))]
+                print(json.dumps({'id': query, 'title': query, 'original_url': spec, 'entries': entries}))
+            else:
+                print(json.dumps({**entry(spec[-11:], duration), 'id': spec[-11:]}))
+        return 0
+
+    spec = specs[-1]
+    vid = spec[-11:] if spec.startswith('http') else video_id(spec.split(':', 1)[1])
+    if '--download-archive' in args:
+        archive = args[args.index('--download-archive') + 1]
+        seen = open(archive, encoding='utf-8').read().split('\n') if os.path.exists(archive) else []
+        if f'youtube {vid}' in seen:
+            print(f'[download] {vid}: has already been recorded in the archive')
+            return 0
+    out = args[args.index('--output') + 1].replace('%(ext)s', 'mp3' if 'mp3' in args else 'm4a')
+    with open(out, 'wb') as f:
+        f.write(MP3_FRAME * 50)
+    if '--download-archive' in args:
+        with open(archive, 'a', encoding='utf-8') as f:
+            f.write(f'youtube {vid}\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+"""Shard queue tests: leases, retries, the HTTP coordinator and local workers.
+
+Runs offline against tests/fake_yt_dlp.py:  python -m pytest tests
+"""
+import csv
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'spotify2media.py')
+FAKE_YT_DLP = os.path.join(HERE, 'fake_yt_dlp.py')
+sys.path.insert(0, os.path.dirname(HERE))
+
+import spotify2media as s2m  # noqa: E402
+
+
+def write_csv(path, n):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['Track Name', 'Artist Name(s)', 'Album Name', 'Duration (ms)'])
+        writer.writeheader()
+        for k in range(1, n + 1):
+            writer.writerow({'Track Name': f'Song {k}', 'Artist Name(s)': 'Artist', 'Album Name': 'Album',
+                             'Duration (ms)': '200000'})
+
+
+class ShardQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.csv = os.path.join(self.dir, 'Mix.csv')
+        write_csv(self.csv, 4)
+        self.path = os.path.join(self.dir, 'job.sqlite')
+        s2m.ShardQueue.create(self.path, self.csv, os.path.join(self.dir, 'out'), {})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_expired_lease_is_reclaimed(self):
+        queue = s2m.ShardQueue(self.path, lease_seconds=0.2)
+        first = queue.claim('a', 2)
+        self.assertEqual([idx for idx, _ in first], [1, 2])
+        self.assertEqual([idx for idx, _ in queue.claim('b', 2)], [3, 4])
+        time.sleep(0.3)
+        self.assertEqual([idx for idx, _ in queue.claim('c', 1)], [1])
+        # The old holder lost the row: its renewal and its result are refused
+        self.assertEqual(queue.renew('a', [1, 2]), [2])
+        self.assertFalse(queue.complete('a', 1, {'file': 'x.mp3'}))
+        self.assertTrue(queue.complete('c', 1, {'file': '001 - Song 1.mp3'}))
+
+    def test_renewed_lease_is_kept(self):
+        queue = s2m.ShardQueue(self.path, lease_seconds=0.3)
+        queue.claim('a', 1)
+        for _ in range(3):
+            time.sleep(0.15)
+            self.assertEqual(queue.renew('a', [1]), [1])
+        self.assertEqual([idx for idx, _ in queue.claim('b', 4)], [2, 3, 4])
+
+    def test_lease_expiring_max_attempts_fails_the_row(self):
+        queue = s2m.ShardQueue(self.path, lease_seconds=0.05, max_attempts=2)
+        for _ in range(2):
+            self.assertEqual([idx for idx, _ in queue.claim('a', 1)], [1])
+            time.sleep(0.1)
+        queue.claim('a', 0)
+        self.assertEqual(queue.status()['failed'], 1)
+        self.assertEqual(queue.results()[0][3]['error'], 'Lease expired too often')
+
+    def test_fail_requeues_until_max_attempts(self):
+        queue = s2m.ShardQueue(self.path, max_attempts=2)
+        queue.claim('a', 1)
+        self.assertTrue(queue.fail('a', 1, 'boom'))
+        self.assertEqual(queue.status()['pending'], 4)
+        queue.claim('a', 1)
+        self.assertTrue(queue.fail('a', 1, 'boom again'))
+        self.assertEqual(queue.status(), {'pending': 3, 'leased': 0, 'done': 0, 'failed': 1})
+        self.assertFalse(queue.fail('a', 1, 'not held any more'))
+
+    def test_http_coordinator(self):
+        server = s2m.serve_shard_queue(s2m.ShardQueue(self.path, lease_seconds=45), '127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            remote = s2m.RemoteShardQueue(f'http://127.0.0.1:{server.server_port}')
+            self.assertEqual(remote.job()['total'], 4)
+            self.assertEqual(remote.lease_seconds, 45)
+            items = remote.claim('w', 2)
+            self.assertEqual([idx for idx, _ in items], [1, 2])
+            self.assertEqual(items[0][1]['Track Name'], 'Song 1')
+            self.assertEqual(remote.renew('w', [1, 2]), [1, 2])
+            self.assertTrue(remote.complete('w', 1, {'file': '001 - Song 1.mp3', 'not_found': None}))
+            self.assertTrue(remote.fail('w', 2, 'boom'))
+            self.assertEqual(remote.status(), {'pending': 3, 'leased': 0, 'done': 1, 'failed': 0})
+            self.assertEqual(remote.results()[0][2], 'done')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class LocalWorkersTest(unittest.TestCase):
+    """Several shard-worker processes on one box; one is killed while holding a lease."""
+
+    ROWS = 8
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        os.chmod(FAKE_YT_DLP, 0o755)
+        # CONFIG_FILE is read from the working directory when running from source
+        with open(os.path.join(self.dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump({'yt_dlp_path': FAKE_YT_DLP, 'ffmpeg_path': FAKE_YT_DLP, 'bulk_window': 0}, f)
+        self.csv = os.path.join(self.dir, 'Mix.csv')
+        write_csv(self.csv, self.ROWS)
+        self.queue = os.path.join(self.dir, 'job.sqlite')
+        self.output = os.path.join(self.dir, 'out')
+        self.cli('shard-init', '--queue', self.queue, '--csv', self.csv, '--output', self.output, '--fast', '--mp3')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cli(self, *args):
+        subprocess.run([sys.executable, SCRIPT, *args], cwd=self.dir, check=True, capture_output=True, text=True)
+
+    def worker(self, name, delay):
+        env = {**os.environ, 'FAKE_YTDLP_DELAY': str(delay)}
+        return subprocess.Popen([sys.executable, SCRIPT, 'shard-worker', '--queue', self.queue, '--id', name, '--lease', '3'],
+                                cwd=self.dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    def test_killed_worker_rows_are_finished_by_the_others(self):
+        queue = s2m.ShardQueue(self.queue)
+        doomed = self.worker('doomed', 60)
+        deadline = time.time() + 30
+        while not queue.status()['leased']:
+            self.assertLess(time.time(), deadline, 'worker never claimed a row')
+            time.sleep(0.1)
+        doomed.send_signal(signal.SIGKILL)
+        doomed.wait()
+
+        # Slower than a renew interval, so live leases must be renewed rather than re-claimed
+        workers = [self.worker(f'w{k}', 1.2) for k in range(2)]
+        for w in workers:
+            out, _ = w.communicate(timeout=120)
+            self.assertEqual(w.returncode, 0, out)
+
+        self.assertEqual(queue.status(), {'pending': 0, 'leased': 0, 'done': self.ROWS, 'failed': 0})
+        db = queue._connect()
+        try:
+            attempts = dict(db.execute("SELECT idx, attempts FROM items").fetchall())
+        finally:
+            db.close()
+        self.assertEqual(attempts[1], 2, 'the killed worker\'s row should have been leased twice')
+        self.assertTrue(all(attempts[idx] == 1 for idx in range(2, self.ROWS + 1)), attempts)
+
+        self.cli('shard-finalize', '--queue', self.queue)
+        folder = os.path.join(self.output, 'Mix')
+        files = sorted(f for f in os.listdir(folder) if f.endswith('.mp3'))
+        self.assertEqual(files, [f'{k:03d} - Song {k}.mp3' for k in range(1, self.ROWS + 1)])
+        with open(os.path.join(folder, 'Mix.m3u'), encoding='utf-8') as f:
+            self.assertEqual(sum(1 for line in f if line.strip().endswith('.mp3')), self.ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()